@@ -62,12 +62,23 @@ class Canvas():
 
         self.root_folder.save()
 
-        for layer in self.root_folder:
+        for layer in self.root_folder.descendants():
             layer.save()
 
     def _init_structure(self):
         
-        layers = self.clip_file.sql_database.get_table("Layer")
+        database = self.clip_file.sql_database
+
+        # Each layer looks up its rows in these tables, read them all at once instead
+        # of querying them per layer
+        database.prefetch(
+            ["Mipmap", "MipmapInfo", "Offscreen", "VectorObjectList"]
+            + [table for table in database.table_scheme if table.startswith("Ruler")],
+            "LayerId"
+        )
+        database.prefetch(["VectorObjectList", "SpecialRulerManager"], "MainId")
+
+        layers = database.get_table("Layer")
 
         root_data = layers[self._data.CanvasRootFolder]
         self.root_folder = BaseLayer.from_db(self.clip_file, root_data)
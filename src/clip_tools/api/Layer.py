@@ -6,17 +6,23 @@ from clip_tools.parsers import *
 from clip_tools.api.Gradient import Gradient
 from clip_tools.api.Effect import LayerEffects
 from clip_tools.api.Correction import parse_correction_attributes
-from clip_tools.data_classes import Color, OffscreenAttribute
+from clip_tools.data_classes import Color, OffscreenAttribute, ResizableImageInfo
 from clip_tools.api.Ruler import Rulers
 from clip_tools.api.Mask import Mask
+from clip_tools.api.Tiles import TileView
+from clip_tools.api.PixelBuffer import PixelBuffer
 from clip_tools.api.Vector import Vector, VectorPoint, VectorList
 from clip_tools.api.Text import Text
 from clip_tools.api import Correction
+from clip_tools.render.cache import caches_empty, invalidate_caches
+from clip_tools.render.correction import compile_correction, stop_lut
+from clip_tools.render.gradient import LUT_SIZE, rasterize_gradient
 import binascii
 import uuid
 import io
 import zlib
 import logging 
+import numpy as np
 
 from typing import (
     Any,
@@ -33,6 +39,27 @@ from collections import namedtuple
 
 logger = logging.getLogger(__name__)
 
+def _union_bbox(bboxes):
+
+    # Union of (left, top, right, bottom) boxes, None (the whole canvas) wins
+
+    union = None
+
+    for bbox in bboxes:
+
+        if bbox is None:
+            return None
+
+        if bbox[0] >= bbox[2] or bbox[1] >= bbox[3]:
+            continue
+
+        if union is None:
+            union = bbox
+        else:
+            union = (min(union[0], bbox[0]), min(union[1], bbox[1]), max(union[2], bbox[2]), max(union[3], bbox[3]))
+
+    return (0, 0, 0, 0) if union is None else union
+
 class BaseLayer():
 
     def __init__(self, clip_file, layer_data):
@@ -225,6 +252,16 @@ class BaseLayer():
     def visible(self):
         return self._data.LayerVisibility & LayerVisibility.VISIBLE
 
+    @visible.setter
+    def visible(self, visible):
+
+        if visible:
+            self._data.LayerVisibility = self._data.LayerVisibility | int(LayerVisibility.VISIBLE)
+        else:
+            self._data.LayerVisibility = self._data.LayerVisibility & ~int(LayerVisibility.VISIBLE)
+
+        self._invalidate()
+
     @property
     def layer_name(self):
         return self._data.LayerName
@@ -240,6 +277,7 @@ class BaseLayer():
     @opacity.setter
     def opacity(self, new_opacity):
         self._data.LayerOpacity = int((new_opacity / 100) * 256)
+        self._invalidate()
 
     @property
     def blend_mode(self):
@@ -248,6 +286,7 @@ class BaseLayer():
     @blend_mode.setter
     def blend_mode(self, new_mode):
         self._data.LayerComposite = new_mode # From constants.BlendMode
+        self._invalidate()
 
     @property
     def clipping(self):
@@ -256,6 +295,7 @@ class BaseLayer():
     @clipping.setter
     def clipping(self, clip):
         self._data.LayerClip = int(bool(clip))
+        self._invalidate()
 
     @property
     def reference(self):
@@ -331,12 +371,57 @@ class BaseLayer():
 
         return offscreen
 
+    def _get_mipmap_levels(self, mipmap):
+
+        # (scale, offscreen) of every level of the mipmap chain, full size first
+
+        levels = []
+
+        mipmap_info = self.mipmap_infos.get(mipmap.BaseMipmapInfo)
+
+        while mipmap_info is not None and len(levels) < len(self.mipmap_infos):
+            levels.append((mipmap_info.ThisScale / 100, self.offscreens[mipmap_info.Offscreen]))
+            mipmap_info = self.mipmap_infos.get(mipmap_info.NextIndex) if mipmap_info.NextIndex else None
+
+        return levels
+
+    def _render_origin(self):
+
+        # Canvas position of the top left pixel of the render offscreen
+        return (
+            (self._data.LayerOffsetX or 0) + (self._data.LayerRenderOffscrOffsetX or 0),
+            (self._data.LayerOffsetY or 0) + (self._data.LayerRenderOffscrOffsetY or 0)
+        )
+
     def _get_offscreen_attributes(self):
         return self._get_render_offscreen(self._get_render_mipmap()).Attribute
 
     def _get_mask_offscreen_attributes(self):
         return self._get_render_offscreen(self._get_mask_render_mipmap()).Attribute
 
+    # Composite cache
+    def _canvas_bbox(self):
+
+        # Canvas area the layer draws on, None when it can be the whole canvas
+        return None
+
+    def _invalidate(self, bbox=None):
+
+        # Drops the cached composites of the parent folders over the canvas bbox,
+        # over the whole layer when None
+
+        if caches_empty():
+            return
+
+        if bbox is None:
+            bbox = self._canvas_bbox()
+
+        folder = self._parent
+
+        while folder is not None:
+            invalidate_caches(folder, bbox)
+            folder = folder._parent
+
     # Structure edition
     def delete_layer(self):
         """
@@ -392,13 +477,26 @@ class FolderMixin():
 
     def __setitem__(self, key, value) -> None:
         self._check_valid_layers(value)
+
+        replaced = self._layers[key]
+
         self._layers.__setitem__(key, value)
         self._update_metadata()
 
+        if isinstance(key, slice):
+            self._children_changed([*replaced, *value])
+        else:
+            self._children_changed([replaced, value])
+
     def __delitem__(self, key) -> None:
+
+        removed = self._layers[key]
+
         self._layers.__delitem__(key)
         self._update_metadata()
 
+        self._children_changed(removed if isinstance(key, slice) else [removed])
+
     def append(self, layer: BaseLayer) -> None:
         """
         Add a layer to the end (top) of the group
@@ -415,10 +513,14 @@ class FolderMixin():
         :param layers: The layers to add
         """
 
+        layers = list(layers)
+
         self._check_valid_layers(layers)
         self._layers.extend(layers)
         self._update_metadata()
 
+        self._children_changed(layers)
+
     def insert(self, index: int, layer: BaseLayer) -> None:
         """
         Insert the given layer at the specified index.
@@ -430,7 +532,9 @@ class FolderMixin():
         self._check_valid_layers(layer)
         self._layers.insert(index, layer)
         self._update_metadata()
-        
+
+        self._children_changed([layer])
+
     def remove(self, layer: BaseLayer):
         """
         Removes the specified layer from the group
@@ -440,6 +544,8 @@ class FolderMixin():
 
         self._layers.remove(layer)
         self._update_metadata()
+
+        self._children_changed([layer])
         return self
 
     def pop(self, index: int = -1) -> BaseLayer:
@@ -451,6 +557,8 @@ class FolderMixin():
 
         popLayer = self._layers.pop(index)
         self._update_metadata()
+
+        self._children_changed([popLayer])
         return popLayer
 
     def clear(self) -> None:
@@ -458,9 +566,13 @@ class FolderMixin():
         Clears the group.
         """
 
+        removed = list(self._layers)
+
         self._layers.clear()
         self._update_metadata()
 
+        self._children_changed(removed)
+
     def index(self, layer: BaseLayer) -> int:
         """
         Returns the index of the specified layer in the group.
@@ -506,6 +618,21 @@ class FolderMixin():
         for i in range(len(self) - 1):
             self[i]._data.LayerNextIndex = self[i + 1]._data.MainId
 
+    def _canvas_bbox(self):
+        return _union_bbox(layer._canvas_bbox() for layer in self._layers)
+
+    def _children_changed(self, layers):
+
+        # Layers were added or removed, their area of the composites is stale
+
+        if not layers or caches_empty():
+            return
+
+        bbox = _union_bbox(layer._canvas_bbox() for layer in layers)
+
+        invalidate_caches(self, bbox)
+        self._invalidate(bbox)
+
     def descendants(self) -> Iterator[BaseLayer]:
         """
         Return a generator to iterate over all descendant layers.
@@ -592,6 +719,8 @@ class RootFolder(Folder):
 
 class PixelLayer(BaseLayer):
 
+    _pixel_buffer = None
+
     @classmethod
     def new(cls, clip_file, name = "Layer"):
 
@@ -604,30 +733,194 @@ class PixelLayer(BaseLayer):
 
         return PixelLayer.frompil(clip_file, pil_im, name)
 
-    def topil(self):
+    def to_numpy(self, workers=None, bbox=None, scale=None):
 
-        if self._get_render_offscreen(self._get_render_mipmap()).BlockData not in self.clip_file.data_chunks.keys():
+        # HxWxC uint8 array, RGBA, LA or L depending on the layer color mode.
+        # With bbox (left, top, right, bottom) only that region is decoded.
+        # With scale (0.25 for a quarter) the closest stored mipmap level at or
+        # above that scale is decoded then resized, bbox is in scaled pixels
+
+        levels = self._get_mipmap_levels(self._get_render_mipmap())
+        base_offscreen = levels[0][1]
+
+        if base_offscreen.BlockData not in self.clip_file.data_chunks.keys():
             return None
 
+        base_attribute = OffscreenAttribute.read(io.BytesIO(base_offscreen.Attribute))
+
+        if scale is None:
+            return self._decode_offscreen(base_offscreen, base_attribute, workers, bbox)
+
+        def scaled_size(level_scale):
+            return (
+                max(1, int(base_attribute.bitmap_width * level_scale)),
+                max(1, int(base_attribute.bitmap_height * level_scale))
+            )
+
+        # Lower levels are often left empty, or don't match their scale, the full
+        # size one is always usable
+        offscreen_scale, offscreen, offscreen_attribute = levels[0][0], base_offscreen, base_attribute
+
+        for level_scale, level_offscreen in levels[1:]:
+
+            if not scale <= level_scale < offscreen_scale or level_offscreen.BlockData not in self.clip_file.data_chunks:
+                continue
+
+            level_attribute = OffscreenAttribute.read(io.BytesIO(level_offscreen.Attribute))
+
+            if (level_attribute.bitmap_width, level_attribute.bitmap_height) == scaled_size(level_scale):
+                offscreen_scale, offscreen, offscreen_attribute = level_scale, level_offscreen, level_attribute
+
+        size = scaled_size(scale)
+
+        if (offscreen_attribute.bitmap_width, offscreen_attribute.bitmap_height) == size:
+            return self._decode_offscreen(offscreen, offscreen_attribute, workers, bbox)
+
+        image = array_to_pil(self._decode_offscreen(offscreen, offscreen_attribute, workers))
+        image = image.resize(size, Image.Resampling.BOX)
+
+        if bbox is not None:
+            image = image.crop(bbox)
+
+        return pil_to_array(image)
+
+    def to_packed(self, workers=None):
+
+        # Monochrome layers only, H x ceil(W/8) x 2 array of the color then alpha
+        # bits (8 pixels per byte, see parsers.pack_monochrome), 8 times smaller
+        # than to_numpy
+
+        offscreen = self._get_render_offscreen(self._get_render_mipmap())
+
+        if offscreen.BlockData not in self.clip_file.data_chunks.keys():
+            return None
+
+        return decode_chunk_to_packed(
+            self.clip_file.data_chunks[offscreen.BlockData],
+            OffscreenAttribute.read(io.BytesIO(offscreen.Attribute)),
+            workers
+        )
+
+    def _decode_offscreen(self, offscreen, offscreen_attribute, workers=None, bbox=None):
+        return decode_chunk_to_array(
+            self.clip_file.data_chunks[offscreen.BlockData],
+            offscreen_attribute,
+            workers,
+            bbox
+        )
+
+    def topil(self, workers=None, bbox=None, scale=None):
+
+        array = self.to_numpy(workers, bbox, scale)
+
+        if array is None:
+            return None
+
+        return array_to_pil(array)
+
+    def pixels(self, workers=None):
+
+        # Editable pixel buffer, only the blocks written to are re-encoded on save
+
+        if self._pixel_buffer is None:
+
+            offscreen = self._get_render_offscreen(self._get_render_mipmap())
+
+            if offscreen.BlockData not in self.clip_file.data_chunks.keys():
+                return None
+
+            self._pixel_buffer = PixelBuffer(
+                self.clip_file.data_chunks[offscreen.BlockData],
+                offscreen,
+                OffscreenAttribute.read(io.BytesIO(offscreen.Attribute)),
+                workers,
+                self._pixels_changed
+            )
+
+        return self._pixel_buffer
+
+    def _canvas_bbox(self):
+
+        mipmap = self._get_render_mipmap()
+
+        if mipmap is None:
+            return (0, 0, 0, 0)
+
+        offscreen_attribute = OffscreenAttribute.read(io.BytesIO(self._get_render_offscreen(mipmap).Attribute))
+        left, top = self._render_origin()
+
+        return (left, top, left + offscreen_attribute.bitmap_width, top + offscreen_attribute.bitmap_height)
+
+    def _pixels_changed(self, bbox):
+
+        # Pixel buffer edit, bbox is in offscreen pixels
+
+        if bbox is None:
+            self._invalidate()
+            return
+
+        left, top = self._render_origin()
+
+        self._invalidate((bbox[0] + left, bbox[1] + top, bbox[2] + left, bbox[3] + top))
+
+    def save(self):
+
+        if self._pixel_buffer is not None:
+            self._pixel_buffer.flush()
+
+        super().save()
+
+    def tiles(self, cache=None):
+
+        # Block by block access to the pixels, decompressed blocks are kept in cache
+        # (the shared Tiles.block_cache by default)
+
         offscreen = self._get_render_offscreen(self._get_render_mipmap())
-        parsed_attribute = OffscreenAttribute.read(io.BytesIO(offscreen.Attribute))
 
-        return decode_chunk_to_pil(
+        if offscreen.BlockData not in self.clip_file.data_chunks.keys():
+            return None
+
+        return TileView(
             self.clip_file.data_chunks[offscreen.BlockData],
-            parsed_attribute
+            OffscreenAttribute.read(io.BytesIO(offscreen.Attribute)),
+            cache
         )
 
     @classmethod
-    def frompil(cls, clip_file, pil_im, name = "Pixel"):
+    def frompil(cls, clip_file, pil_im, name = "Pixel", profile = None, workers = None, processes = False):
+        return cls.from_numpy(clip_file, pil_to_array(pil_im), name, ColorMode.from_pil(pil_im.mode), profile, workers, processes)
+
+    @classmethod
+    def from_numpy(cls, clip_file, array, name = "Pixel", color_mode = None, profile = None, workers = None, processes = False):
+
+        # array is HxW or HxWxC, gray, gray + alpha, RGB or RGBA. With processes the
+        # blocks are compressed in a process pool instead of threads, for large images
+        encode = encode_array_to_chunk_parallels if processes else encode_array_to_chunk
+
+        chunk, offscreen_attribute = encode(array, color_mode, profile, workers)
+
+        if color_mode is None:
+            color_mode = ColorMode.RGB if offscreen_attribute.packing_attributes.buffer_channel_count > 1 else ColorMode.GRAYSCALE
+
+        return cls._from_chunk(clip_file, chunk, offscreen_attribute, name, color_mode)
+
+    @classmethod
+    def from_packed(cls, clip_file, packed, width, name = "Pixel", profile = None, workers = None):
+
+        # Monochrome layer from a packed bitmap, see to_packed
+        chunk, offscreen_attribute = encode_packed_to_chunk(packed, width, profile, workers)
+
+        return cls._from_chunk(clip_file, chunk, offscreen_attribute, name, ColorMode.MONOCHROME)
+
+    @classmethod
+    def _from_chunk(cls, clip_file, chunk, offscreen_attribute, name, color_mode):
 
         layer_data = BaseLayer._new(clip_file, name)
         layer_data.LayerType = LayerType.PIXEL
-        layer_data.LayerColorTypeIndex = ColorMode.from_pil(pil_im.mode)
+        layer_data.LayerColorTypeIndex = color_mode
         layer_data.LayerColorTypeBlackChecked = 1
         layer_data.LayerColorTypeWhiteChecked = 1
 
-        chunk, offscreen_attribute = encode_pil_to_chunk(pil_im)
-
         mipmap = clip_file.sql_database.get_referenced_items("Mipmap", "LayerId", layer_data.MainId)
         mipinfos = clip_file.sql_database.get_referenced_items("MipmapInfo", "LayerId", layer_data.MainId)
         offscreens = clip_file.sql_database.get_referenced_items("Offscreen", "LayerId", layer_data.MainId)
@@ -646,21 +939,54 @@ class PixelLayer(BaseLayer):
 
 class ImageLayer(BaseLayer):
 
-    def topil(self):
+    # Image files placed on the canvas. The original image is kept in the
+    # ResizableOriginalMipmap offscreen, its placement in ResizableImageInfo
+
+    @property
+    def image_info(self):
 
-        if self._get_render_offscreen(self.mipmaps[self._data.ResizableOriginalMipmap]).BlockData not in self.clip_file.data_chunks.keys():
+        if self._data.ResizableImageInfo is None:
+            return None
+
+        return ResizableImageInfo.read(self._data.ResizableImageInfo)
+
+    def _original_offscreen(self):
+
+        if not self._data.ResizableOriginalMipmap:
             return None
 
         offscreen = self._get_render_offscreen(self.mipmaps[self._data.ResizableOriginalMipmap])
 
-        parsed_attribute = parse_offscreen_attribute(offscreen.Attribute)
+        if offscreen.BlockData not in self.clip_file.data_chunks.keys():
+            return None
+
+        return offscreen
 
-        #print(parsed_attribute)
-        return decode_chunk_to_pil(
+    def to_numpy(self, workers=None):
+
+        # HxWxC uint8 of the original image, before it is placed on the canvas
+
+        offscreen = self._original_offscreen()
+
+        if offscreen is None:
+            return None
+
+        return decode_chunk_to_array(
             self.clip_file.data_chunks[offscreen.BlockData],
-            parsed_attribute
+            OffscreenAttribute.read(io.BytesIO(offscreen.Attribute)),
+            workers
         )
 
+    def topil(self, workers=None):
+
+        array = self.to_numpy(workers)
+
+        if array is None:
+            return None
+
+        return array_to_pil(array)
+
+
 class PaperLayer(BaseLayer):
 
     @property
@@ -674,6 +1000,7 @@ class PaperLayer(BaseLayer):
         self._data.DrawColorMainRed = new_color.r << 24
         self._data.DrawColorMainGreen = new_color.g << 24
         self._data.DrawColorMainBlue = new_color.b << 24
+        self._invalidate()
 
     @classmethod
     def new(cls, clip_file, layer_name = "Paper", color = Color(0, 0, 0)):
@@ -774,8 +1101,14 @@ class CorrectionLayer(BaseLayer):
 
         BaseLayer.__init__(self, clip_file, layer_data)
 
+        self._correction = None
+
+        # (correction bytes, render.correction.CompiledCorrection)
+        self._compiled = None
+
         if self._data.FilterLayerInfo is not None:
             self._correction = parse_correction_attributes(self._data.FilterLayerInfo)
+            self._compiled = (self._correction.to_bytes(), None)
 
     @property
     def correction(self):
@@ -785,6 +1118,27 @@ class CorrectionLayer(BaseLayer):
     def correction(self, new_correction):
         self._correction = new_correction
         self._data.FilterLayerInfo = self._correction.to_bytes()
+        self._invalidate()
+
+    def compiled_correction(self):
+
+        # The correction as LUTs and kernels for rendering, compiled again only
+        # when its values changed. Edits made in place also invalidate the
+        # composites
+
+        if self._correction is None:
+            return None
+
+        key = self._correction.to_bytes()
+
+        if self._compiled is not None and self._compiled[0] != key:
+            self._compiled = None
+            self._invalidate()
+
+        if self._compiled is None or self._compiled[1] is None:
+            self._compiled = (key, compile_correction(self._correction))
+
+        return self._compiled[1]
 
     def save(self):
 
@@ -829,7 +1183,67 @@ class GradientLayer(BaseLayer):
     def __init__(self, clip_file, layer_data):
 
         BaseLayer.__init__(self, clip_file, layer_data)
-        self.gradient = Gradient.from_bytes(self._data.GradationFillInfo)
+        self._gradient = Gradient.from_bytes(self._data.GradationFillInfo)
+
+        # Gradient bytes the composites were made with, and their stop LUT
+        self._rendered = self._gradient.to_bytes()
+        self._lut = None
+
+    @property
+    def gradient(self):
+        return self._gradient
+
+    @gradient.setter
+    def gradient(self, new_gradient):
+        self._gradient = new_gradient
+        self._data.GradationFillInfo = new_gradient.to_bytes()
+        self._invalidate()
+
+    def gradient_lut(self):
+
+        # Stop LUT for rendering. Edits made on the gradient in place are found
+        # here, the LUT is built again and the composites are invalidated
+
+        key = self._gradient.to_bytes()
+
+        if key != self._rendered:
+            self._rendered = key
+            self._lut = None
+            self._invalidate()
+
+        if self._lut is None:
+            self._lut = stop_lut(self._gradient.color_stops, LUT_SIZE)
+
+        return self._lut
+
+    def _gradient_offset(self):
+        return (self._data.LayerOffsetX or 0, self._data.LayerOffsetY or 0)
+
+    def to_numpy(self, bbox=None, scale=None):
+
+        # HxWx4 RGBA uint8 of the gradient over the canvas, rasterized as there
+        # is no pixel data. bbox and scale work as in PixelLayer.to_numpy
+
+        canvas = self.clip_file.sql_database.get_table("Canvas")[1]
+
+        if scale is None:
+            scale = 1
+
+        if bbox is None:
+            bbox = (0, 0, max(1, int(canvas.CanvasWidth * scale)), max(1, int(canvas.CanvasHeight * scale)))
+
+        tile = rasterize_gradient(self.gradient, bbox, scale, self._gradient_offset())
+
+        alpha = tile[:, :, 3:]
+
+        array = np.empty(tile.shape, dtype=np.uint8)
+        array[:, :, :3] = np.rint(np.divide(tile[:, :, :3], alpha, out=np.zeros_like(tile[:, :, :3]), where=alpha > 0) * 255)
+        array[:, :, 3] = np.rint(tile[:, :, 3] * 255)
+
+        return array
+
+    def topil(self, bbox=None, scale=None):
+        return array_to_pil(self.to_numpy(bbox, scale))
 
     @classmethod
     def new(cls, clip_file, gradient, layer_name = "Gradient"):
@@ -895,6 +1309,11 @@ class VectorLayer(BaseLayer):
         self.lines = []
 
         for vector_chunk in vector_chunks.values():
+
+            # Probed files have no external chunks, anywhere else a missing one is an error
+            if self.clip_file.database_only:
+                continue
+
             self.lines.append(
                 VectorList.read(
                     self.clip_file.data_chunks[vector_chunk.VectorData].block_data.data
@@ -0,0 +1,152 @@
+from clip_tools.parsers import decode_chunk_to_array, encode_block, pil_to_array
+from clip_tools.clip.DataChunk import Block
+from PIL import Image
+import numpy as np
+
+class PixelBuffer():
+
+    # Editable HxWxC array of a pixel chunk. Writes through buffer[...] = value or
+    # paste mark the blocks they touch, flush only re-encodes those blocks in the
+    # existing chunk. Edits made directly on .array have to be marked with mark_dirty.
+    # on_change is called with the bbox of every marked edit (None for all of it)
+
+    def __init__(self, chunk, offscreen, offscreen_attribute, workers=None, on_change=None):
+        self.chunk = chunk
+        self.offscreen = offscreen
+        self.offscreen_attribute = offscreen_attribute
+        self.on_change = on_change
+
+        self.array = decode_chunk_to_array(chunk, offscreen_attribute, workers)
+
+        # (row, col) of the modified blocks
+        self.dirty_blocks = set()
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    def __getitem__(self, key):
+
+        # Read-only, writes have to go through __setitem__ to be tracked
+        view = self.array[key]
+
+        if isinstance(view, np.ndarray):
+            view = view.view()
+            view.flags.writeable = False
+
+        return view
+
+    def __setitem__(self, key, value):
+        self.array[key] = value
+        self.mark_dirty(self._key_bbox(key))
+
+    def paste(self, image, position=(0, 0)):
+
+        # image is a PIL image or an array with the buffer channels, clipped to the buffer
+
+        if isinstance(image, Image.Image):
+            image = pil_to_array(image)
+
+        left, top = position
+        height, width = self.array.shape[:2]
+
+        x0, y0 = max(left, 0), max(top, 0)
+        x1, y1 = min(left + image.shape[1], width), min(top + image.shape[0], height)
+
+        if x0 >= x1 or y0 >= y1:
+            return
+
+        self[y0:y1, x0:x1] = image[y0 - top:y1 - top, x0 - left:x1 - left]
+
+    def mark_dirty(self, bbox=None):
+
+        # bbox is (left, top, right, bottom), everything when None
+
+        pix_packing = self.offscreen_attribute.packing_attributes
+
+        if bbox is None:
+            bbox = (0, 0, self.array.shape[1], self.array.shape[0])
+
+        left, top, right, bottom = bbox
+
+        if right <= left or bottom <= top:
+            return
+
+        if self.on_change is not None:
+            self.on_change(bbox)
+
+        self.dirty_blocks.update(
+            (h, w)
+            for h in range(max(top // pix_packing.block_height, 0), min((bottom - 1) // pix_packing.block_height + 1, self.offscreen_attribute.block_grid_height))
+            for w in range(max(left // pix_packing.block_width, 0), min((right - 1) // pix_packing.block_width + 1, self.offscreen_attribute.block_grid_width))
+        )
+
+    def _key_bbox(self, key):
+
+        # Rectangle covered by an index on the first two axes, None when it can't be told
+
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        bounds = []
+
+        for axis, size in enumerate(self.array.shape[:2]):
+
+            index = key[axis] if axis < len(key) else slice(None)
+
+            if isinstance(index, (int, np.integer)):
+                selected = range(size)[index:index + 1 or None]
+            elif isinstance(index, slice):
+                selected = range(size)[index]
+            else:
+                return None # Ellipsis, masks and index arrays
+
+            if len(selected) == 0:
+                return (0, 0, 0, 0)
+
+            bounds.append((min(selected[0], selected[-1]), max(selected[0], selected[-1]) + 1))
+
+        (top, bottom), (left, right) = bounds
+
+        return (left, top, right, bottom)
+
+    def flush(self, profile=None):
+
+        # Re-encodes the dirty blocks, blocks left at the fill color are stored empty
+
+        if not self.dirty_blocks:
+            return
+
+        offscreen_attribute = self.offscreen_attribute
+        pix_packing = offscreen_attribute.packing_attributes
+
+        height, width, channel_count = self.array.shape
+        fill = 255*offscreen_attribute.default_fill_color
+
+        block_array = np.zeros((pix_packing.block_height, pix_packing.block_width, channel_count), dtype=np.uint8)
+
+        for h, w in sorted(self.dirty_blocks):
+
+            index = h * offscreen_attribute.block_grid_width + w
+
+            top = h * pix_packing.block_height
+            left = w * pix_packing.block_width
+
+            region = self.array[top:top + pix_packing.block_height, left:left + pix_packing.block_width]
+
+            if (region == fill).all():
+                block = Block.new(index, None)
+            else:
+                # Out of the bitmap is padded with 0
+                block_array.fill(0)
+                block_array[:region.shape[0], :region.shape[1]] = region
+
+                block = Block.new(index, encode_block(block_array, pix_packing, profile))
+
+            self.chunk.block_data[index] = block
+            offscreen_attribute.block_sizes[index] = block.byte_size()
+
+        self.offscreen.Attribute = offscreen_attribute.tobytes()
+        self.offscreen.save()
+
+        self.dirty_blocks.clear()
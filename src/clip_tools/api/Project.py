@@ -2,7 +2,16 @@ from clip_tools.clip.ClipStudioFile import ClipStudioFile
 from clip_tools.api.Canvas import Canvas
 from clip_tools.clip import ClipData
 from clip_tools.constants import ColorMode, CanvasChannelOrder
-from clip_tools.api.Layer import RootFolder, PixelLayer
+from clip_tools.api.Layer import FolderMixin, RootFolder, PixelLayer
+from clip_tools.clip.DataChunk import BlockData
+from clip_tools.data_classes import OffscreenAttribute
+from clip_tools.render.cache import CompositeCache, invalidate_caches
+from clip_tools.render.compositor import Compositor
+from PIL import Image
+import concurrent.futures
+import io
+import os
+import tempfile
 
 class Project():
 
@@ -14,20 +23,166 @@ class Project():
 
         self.canvas = Canvas(clip_file, canvas_data)
 
-    def save(self, fp):
+        # Folder composites kept between renders, freed with the project
+        self.composite_cache = CompositeCache()
+
+    def save(self, fp, profile=None, recompress=False, workers=None):
+
+        # profile is the compression of the blocks encoded for this save: the edited
+        # blocks of pixel buffers and the chunks of layers created since opening.
+        # Chunks read from the file are copied as is, with recompress every pixel
+        # block is recompressed on workers threads.
+        # A path is written to a temporary file then moved over it, so a project
+        # can be saved back to the file it was lazily opened from
+
+        if isinstance(fp, (str, os.PathLike)):
+
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(fp)), suffix=".clip", delete=False) as f:
+                try:
+                    self.save(f, profile, recompress, workers)
+                except BaseException:
+                    f.close()
+                    os.remove(f.name)
+                    raise
+
+            os.replace(f.name, fp)
+            return
 
         self._data.save()
+
+        # Dirty blocks are encoded with the profile, saving the layers then has nothing left to flush
+        for layer in self.canvas.root_folder.descendants():
+            if isinstance(layer, PixelLayer) and layer._pixel_buffer is not None:
+                layer._pixel_buffer.flush(profile)
+
         self.canvas.save()
+
+        if profile is not None or recompress:
+            self._recompress(profile, recompress, workers)
+
         self.clip_file.write(fp)
 
+    def _recompress(self, profile, every_chunk=False, workers=None):
+
+        # BlockData id -> (chunk, offscreens using it)
+        chunks = {}
+
+        for layer in [self.canvas.root_folder, *self.canvas.root_folder.descendants()]:
+            for offscreen in layer.offscreens.values():
+
+                chunk = self.clip_file.data_chunks.get(offscreen.BlockData)
+
+                if chunk is None:
+                    continue
+
+                # Checked first, lazily opened chunks aren't loaded for nothing
+                if chunk.offset is not None and not every_chunk:
+                    continue
+
+                if not isinstance(chunk.block_data, BlockData):
+                    continue
+
+                chunks.setdefault(offscreen.BlockData, (chunk, []))[1].append(offscreen)
+
+        if not chunks:
+            return
+
+        # zlib releases the GIL, chunks are recompressed side by side
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(lambda chunk: chunk.block_data.recompress(profile), [chunk for chunk, _ in chunks.values()]))
+
+        for chunk, offscreens in chunks.values():
+
+            block_sizes = [block.byte_size() for block in chunk.block_data]
+
+            # The attribute lists the size of every block, keep it in sync
+            for offscreen in offscreens:
+                offscreen_attribute = OffscreenAttribute.read(io.BytesIO(offscreen.Attribute))
+                offscreen_attribute.block_sizes = block_sizes
+
+                offscreen.Attribute = offscreen_attribute.tobytes()
+                offscreen.save()
+
+    def save_inplace(self, fp):
+
+        # Rewrites only the database of the file the project was opened from.
+        # Pixel and vector data can't be changed, use save for that
+
+        if isinstance(fp, (str, os.PathLike)):
+            with open(fp, "r+b") as f:
+                return self.save_inplace(f)
+
+        self._data.save()
+        self.canvas.save()
+        self.clip_file.write_inplace(fp)
+
+    def render(self, workers=None, bbox=None, cache=None):
+
+        # Flattened canvas as an HxWx4 RGBA uint8 array, rendered tile by tile.
+        # bbox (left, top, right, bottom) renders only that region. Unchanged
+        # folders are reused from cache, the project's own one by default.
+        # Layers that can't be rendered are left out with a warning, see Compositor
+
+        if cache is None:
+            cache = self.composite_cache
+
+        return Compositor(self.canvas, cache=cache).render(workers, bbox)
+
+    def close(self):
+
+        # Tiles of the project left in caches shared with other projects are dropped too
+        for layer in [self.canvas.root_folder, *self.canvas.root_folder.descendants()]:
+            if isinstance(layer, FolderMixin):
+                invalidate_caches(layer)
+
+        self.composite_cache.clear()
+        self.clip_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @classmethod
+    def open(cls, fp, lazy=False, use_mmap=False):
+
+        # lazy and use_mmap keep reading fp after opening (see ClipStudioFile.read),
+        # fp has to stay open and can only be saved over with save(path)
+
+        clip_file = ClipStudioFile.read(fp, lazy, use_mmap)
+        data = clip_file.sql_database.fetch_project_data()
+
+        return cls(clip_file, data)
+
     @classmethod
-    def open(cls, fp):
+    def probe(cls, fp):
+
+        # Database only project, for metadata and previews. Layers pixels aren't available.
 
-        clip_file = ClipStudioFile.read(fp)
+        if isinstance(fp, (str, os.PathLike)):
+            with open(fp, "rb") as f:
+                return cls.probe(f)
+
+        clip_file = ClipStudioFile.probe(fp)
         data = clip_file.sql_database.fetch_project_data()
 
         return cls(clip_file, data)
 
+    @property
+    def preview(self):
+
+        previews = self.clip_file.sql_database.get_table("CanvasPreview")
+
+        if not previews:
+            return None
+
+        for preview in previews.values():
+            if preview.CanvasId == self._data.ProjectCanvas:
+                return Image.open(io.BytesIO(preview.ImageData))
+
+        return None
+
     @classmethod
     def new(
         cls,
@@ -32,15 +32,22 @@ class Rulers():
 
         if layer._data.RulerVectorIndex is not None and layer._data.RulerVectorIndex > 0:
 
-            ext_vector_ref = layer.clip_file.sql_database.get_table("VectorObjectList")[layer._data.RulerVectorIndex].VectorData
-            vector_blob = layer.clip_file.data_chunks[ext_vector_ref].block_data.data
+            ext_vector_ref = layer.clip_file.sql_database.get_referenced_items(
+                "VectorObjectList", "MainId", layer._data.RulerVectorIndex
+            )[layer._data.RulerVectorIndex].VectorData
 
-            vectors = VectorList.read(vector_blob)
-            rulers.append(VectorRuler(layer, vectors))
+            # Probed files have no external chunks, anywhere else a missing one is an error
+            if not layer.clip_file.database_only:
+                vector_blob = layer.clip_file.data_chunks[ext_vector_ref].block_data.data
+
+                vectors = VectorList.read(vector_blob)
+                rulers.append(VectorRuler(layer, vectors))
 
         if layer._data.SpecialRulerManager is not None and layer._data.SpecialRulerManager > 0:
 
-            manager = layer.clip_file.sql_database.get_table("SpecialRulerManager")[layer._data.SpecialRulerManager]
+            manager = layer.clip_file.sql_database.get_referenced_items(
+                "SpecialRulerManager", "MainId", layer._data.SpecialRulerManager
+            )[layer._data.SpecialRulerManager]
 
             columns = ["FirstParallel",
                         "FirstCurveParallel", 
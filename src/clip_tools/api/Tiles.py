@@ -0,0 +1,133 @@
+from clip_tools.parsers import decode_chunk_to_array
+from collections import OrderedDict
+import threading
+import numpy as np
+
+# Shared by every tile view unless one is given
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+
+class BlockCache():
+
+    # LRU of decompressed blocks bounded by the total size of the arrays.
+    # Entries are checked against the block and its data so replaced or edited
+    # blocks are never served stale
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, block):
+
+        with self._lock:
+            entry = self._entries.get(id(block))
+
+            if entry is None or entry[0] is not block or entry[1] is not block.data:
+                return None
+
+            self._entries.move_to_end(id(block))
+
+            return entry[2]
+
+    def put(self, block, tile):
+
+        if tile.nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            previous = self._entries.pop(id(block), None)
+
+            if previous is not None:
+                self.nbytes -= previous[2].nbytes
+
+            self._entries[id(block)] = (block, block.data, tile)
+            self.nbytes += tile.nbytes
+
+            while self.nbytes > self.max_bytes:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+block_cache = BlockCache()
+
+class TileView():
+
+    # Lazy 2D view over the blocks of a pixel chunk, tiles[row, col] gives the
+    # HxWxC array of one block (edge tiles are cropped to the bitmap).
+    # Returned tiles are read-only, they may be shared through the cache
+
+    def __init__(self, chunk, offscreen_attribute, cache=None):
+        self.chunk = chunk
+        self.offscreen_attribute = offscreen_attribute
+        self.cache = block_cache if cache is None else cache
+
+        pix_packing = offscreen_attribute.packing_attributes
+
+        self.tile_width = pix_packing.block_width
+        self.tile_height = pix_packing.block_height
+        self.channel_count = min(pix_packing.buffer_channel_count, 3) + pix_packing.alpha_channel_count
+
+        # Empty blocks are broadcast views of a single pixel
+        self._fill_pixel = np.full(self.channel_count, 255*offscreen_attribute.default_fill_color, dtype=np.uint8)
+
+    @property
+    def shape(self):
+        return (self.offscreen_attribute.block_grid_height, self.offscreen_attribute.block_grid_width)
+
+    def __len__(self):
+        return self.shape[0] * self.shape[1]
+
+    def bbox(self, row, col):
+
+        left = col * self.tile_width
+        top = row * self.tile_height
+
+        return (
+            left,
+            top,
+            min(left + self.tile_width, self.offscreen_attribute.bitmap_width),
+            min(top + self.tile_height, self.offscreen_attribute.bitmap_height)
+        )
+
+    def __getitem__(self, key):
+
+        row, col = key
+        rows, cols = self.shape
+
+        if row < 0:
+            row += rows
+        if col < 0:
+            col += cols
+
+        if not (0 <= row < rows and 0 <= col < cols):
+            raise IndexError("Tile (%d, %d) out of a %dx%d grid" % (key[0], key[1], rows, cols))
+
+        left, top, right, bottom = self.bbox(row, col)
+        block = self.chunk.block_data[row * cols + col]
+
+        if not block.data_present:
+            return np.broadcast_to(self._fill_pixel, (bottom - top, right - left, self.channel_count))
+
+        tile = self.cache.get(block)
+
+        if tile is None:
+            tile = decode_chunk_to_array(self.chunk, self.offscreen_attribute, 1, (left, top, right, bottom))
+            tile.flags.writeable = False
+
+            self.cache.put(block, tile)
+
+        return tile
+
+    def __iter__(self):
+
+        rows, cols = self.shape
+
+        for row in range(rows):
+            for col in range(cols):
+                yield self[row, col]
@@ -1,4 +1,4 @@
-from clip_tools.utils import read_fmt, write_fmt
+from clip_tools.utils import read_fmt, write_fmt, write_bytes
 import io
 from attrs import define
 
@@ -6,6 +6,10 @@ from attrs import define
 class ChunkHeader:
 
     chunk_signature: str = b'CHNKHead'
+    database_offset: int
+
+    def __init__(self, database_offset=0):
+        self.database_offset = database_offset
 
     @classmethod
     def new(cls):
@@ -25,13 +29,18 @@ class ChunkHeader:
 
         header_data = fp.read(16) # Unknown yet irrelevant data
 
-        return cls()
+        return cls(database_offset)
+
+    def byte_size(self):
+        return 56
 
     def write(self, fp):
 
-        fp.write(ChunkHeader.chunk_signature)
-        write_fmt(fp, ">q", 40)
-        write_fmt(fp, ">q", 256)
-        write_fmt(fp, ">q", 0) # Will be rewriten with the db address
-        write_fmt(fp, ">q", 16)
-        fp.write(b'\x00'*16)
+        written = write_bytes(fp, ChunkHeader.chunk_signature)
+        written += write_fmt(fp, ">q", 40)
+        written += write_fmt(fp, ">q", 256)
+        written += write_fmt(fp, ">q", self.database_offset)
+        written += write_fmt(fp, ">q", 16)
+        written += write_bytes(fp, b'\x00'*16)
+
+        return written
@@ -9,6 +9,9 @@ class ClipData():
     db: Database
     PW_ID: int = None
 
+    # Row as last read from or written to the database
+    _saved_row: tuple = field(default=None, init=False, eq=False, repr=False)
+
     # For API defined objects
     @classmethod
     def new(cls, db, **kwarg):
@@ -65,14 +68,13 @@ class ClipData():
             self.db.alter_table(class_name, new_columns)
             table_scheme = self.db.table_scheme[class_name]
 
-        data_to_add = {attribute:attr.asdict(self)[attribute] for attribute in table_scheme}
+        if self.PW_ID is None or self.PW_ID == -1:
+            self.PW_ID = self.db.get_free_pw_id(class_name)
 
-        ids = [x[0] for x in self.db._execute_query(f"Select _PW_ID from {class_name}")]
+        row = tuple(getattr(self, attribute) for attribute in table_scheme)
 
-        if self.PW_ID not in ids:
-            self.PW_ID = self.db.insert_new_entry(class_name, data_to_add)
-        else:
-            self.db.edit_entry(class_name, data_to_add)
+        # Written in batch on the next flush, reads from the database flush first
+        self.db.stage(self, row)
 
 
 @attr.define
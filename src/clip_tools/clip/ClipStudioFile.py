@@ -4,7 +4,9 @@ from clip_tools.clip.DataChunk import DataChunks
 from clip_tools.clip.Database import Database
 from clip_tools.clip.Footer import Footer
 
-from clip_tools.utils import read_fmt, write_fmt
+from clip_tools.utils import read_fmt, write_fmt, write_bytes, BufferReader, file_identity
+
+import mmap
 
 class ClipStudioFile:
 
@@ -17,11 +19,19 @@ class ClipStudioFile:
     sql_database: Database
     footer: Footer
 
-    def __init__(self, header, data_chunks, sql_database):
+    def __init__(self, header, data_chunks, sql_database, database_only=False):
         self.header = header
         self.data_chunks = data_chunks
         self.sql_database = sql_database
 
+        # Probed files don't hold the external chunks and can't be written back
+        self.database_only = database_only
+
+        self._mapping = None
+
+        # File the chunks are still read from, it can't be overwritten while they are used
+        self._source = None
+
     @classmethod
     def new(cls):
         return cls(
@@ -31,38 +41,140 @@ class ClipStudioFile:
         )
 
     @classmethod
-    def read(cls, fp):
+    def read(cls, fp, lazy=False, use_mmap=False):
+
+        # With lazy, the block data of the external chunks is only read on access,
+        # fp has to stay open as long as the chunks are used.
+        # With use_mmap, blocks point into a read only mapping of the file. Both
+        # keep reading the source file, it can't be written over: pass its path
+        # to Project.save, which replaces it with a new file, truncating a mapped
+        # file would crash the process (SIGBUS)
+
+        mapping = None
+        source = file_identity(fp) if lazy or use_mmap else None
+
+        if use_mmap:
+            # Block data becomes memoryview slices of the mapped file, nothing is
+            # copied until decompression
+            mapping = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            fp = BufferReader(mapping)
 
         assert ClipStudioFile.chunk_signature == fp.read(8)
         file_size = read_fmt(">q", fp)
         header_offset = read_fmt(">q", fp)
 
         header = ChunkHeader.read(fp)
-        data_chunks = DataChunks.read(fp)
+        data_chunks = DataChunks.read(fp, lazy)
         sql_database = Database.read(fp)
         footer = Footer.read(fp)
 
-        return cls(header, data_chunks, sql_database)
+        clip_file = cls(header, data_chunks, sql_database)
+        clip_file._mapping = mapping
+        clip_file._source = source
+
+        return clip_file
+
+    @classmethod
+    def probe(cls, fp):
+
+        # Reads the headers then jumps to the database, the external chunks are never read
+
+        assert ClipStudioFile.chunk_signature == fp.read(8)
+        file_size = read_fmt(">q", fp)
+        header_offset = read_fmt(">q", fp)
+
+        fp.seek(header_offset)
+        header = ChunkHeader.read(fp)
+
+        fp.seek(header.database_offset)
+        sql_database = Database.read(fp)
+
+        return cls(header, DataChunks.new(), sql_database, database_only=True)
+
+    def close(self):
+
+        self.sql_database.close()
+        self.data_chunks.clear()
+
+        if self._mapping is not None:
+            try:
+                self._mapping.close()
+            except BufferError:
+                pass # Blocks still referenced elsewhere, the mapping is released with them
+
+            self._mapping = None
 
     def write(self, fp):
 
-        fp.write(ClipStudioFile.chunk_signature)
-        size_ptr = fp.tell()
-        write_fmt(fp, ">q", 0)
-        write_fmt(fp, ">q", 24)
+        if self.database_only:
+            raise ValueError("Probed files only hold the database and can't be written")
+
+        # Opening the source for writing already truncated it, the unloaded chunks
+        # are gone and the mapped pages can't be read anymore
+        if self._source is not None and self._source == file_identity(fp):
+            raise ValueError("Can't write over the file the chunks are read from, give Project.save its path instead")
+
+        # Every offset and size is computed before writing, the file is emitted in
+        # a single forward pass so fp doesn't need to be seekable
+        header_offset = 24
+        chunks_offset = header_offset + self.header.byte_size()
+
+        ext_id_offsets, db_offset = self.data_chunks.offsets(chunks_offset)
+
+        self.sql_database.set_external_chunks(ext_id_offsets)
+        database = self.sql_database.serialize()
+
+        file_size = db_offset + 16 + len(database) + Footer.byte_size()
+
+        self.header.database_offset = db_offset
+
+        written = write_bytes(fp, ClipStudioFile.chunk_signature)
+        written += write_fmt(fp, ">q", file_size)
+        written += write_fmt(fp, ">q", header_offset)
+
+        written += self.header.write(fp)
+        written += self.data_chunks.write(fp)
+        written += self.sql_database.write(fp, database)
+        written += Footer.write(fp)
+
+        assert written == file_size
+
+        return written
+
+    def write_inplace(self, fp):
 
-        self.header.write(fp)
-        ext_id_offsets, _ = self.data_chunks.write(fp)
+        # Patches the file fp was read from, fp has to be opened in r+b.
+        # The external chunks stay where they are, only the database and the footer
+        # are rewritten at the database offset
 
-        # Write the db address to the header
-        db_offset = fp.tell()
-        fp.seek(0x30)
-        write_fmt(fp, ">q", db_offset)
-        fp.seek(db_offset)
+        if not self.database_only:
 
-        self.sql_database.write(fp, ext_id_offsets)
-        Footer.write(fp)
+            ext_id_offsets = []
 
-        file_size = fp.tell()
-        fp.seek(size_ptr, 0)
+            for chunk_id, chunk in self.data_chunks.items():
+
+                if chunk.modified or chunk.offset is None:
+                    raise ValueError("Only database changes can be saved in place, chunk %s was modified" % chunk_id.decode("UTF-8"))
+
+                if chunk.offset + chunk.byte_size() > self.header.database_offset:
+                    raise ValueError("Chunk %s doesn't belong to the file being patched" % chunk_id.decode("UTF-8"))
+
+                ext_id_offsets.append((chunk_id, chunk.offset))
+
+            self.sql_database.set_external_chunks(ext_id_offsets)
+
+        # Probed files keep the ExternalChunk table they were read with, the offsets are still valid
+
+        fp.seek(self.header.database_offset)
+
+        written = self.sql_database.write(fp)
+        written += Footer.write(fp)
+
+        fp.truncate()
+
+        file_size = self.header.database_offset + written
+
+        fp.seek(8)
         write_fmt(fp, ">q", file_size)
+
+        return file_size
@@ -1,13 +1,15 @@
-from clip_tools.utils import read_fmt, write_fmt, write_bytes, read_csp_str, write_csp_str
+from clip_tools.utils import read_fmt, write_fmt, write_bytes, read_csp_str, write_csp_str, BufferReader, copy_bytes
 from clip_tools.clip.Database import Database
+from clip_tools import codec
 import io 
 import zlib
 import binascii
-from attrs import define
+from attrs import define, field
 from Cryptodome.Hash import MD5
 import random
 import time
 import struct
+import threading
 
 class Block:
     begin_chunk_signature: str = 'BlockDataBeginChunk'.encode('UTF-16BE')
@@ -21,9 +23,39 @@ class Block:
     data: b''
 
     def __init__(self, block_data_index, data_present, data):
-        self.block_data_index = block_data_index
-        self.data_present = data_present
-        self.data = data
+        self._block_data_index = block_data_index
+        self._data_present = data_present
+        self._data = data
+
+        # Any change to the fields invalidates the raw payload of the chunk
+        self.modified = False
+
+    @property
+    def block_data_index(self):
+        return self._block_data_index
+
+    @block_data_index.setter
+    def block_data_index(self, new_index):
+        self._block_data_index = new_index
+        self.modified = True
+
+    @property
+    def data_present(self):
+        return self._data_present
+
+    @data_present.setter
+    def data_present(self, new_data_present):
+        self._data_present = new_data_present
+        self.modified = True
+
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self, new_data):
+        self._data = new_data
+        self.modified = True
 
     @classmethod
     def new(cls, index, data = None):
@@ -67,10 +99,19 @@ class Block:
 
         return cls(block_data_index, data_present, data)
 
+    def byte_size(self):
+
+        # Fixed part: sizes, both signatures, index, unknown bytes and data_present
+        size = 12 + len(Block.begin_chunk_signature) + 20 + len(Block.end_chunk_signature)
+
+        if self.data_present:
+            size += 8 + len(self.data)
+
+        return size
+
     def write(self, fp):
 
-        block_size_offset = fp.tell()
-        written = write_fmt(fp, ">i", 0)
+        written = write_fmt(fp, ">i", self.byte_size())
 
         written += write_fmt(fp, ">i", len(Block.begin_chunk_signature) // 2)
         written += write_bytes(fp, Block.begin_chunk_signature)
@@ -80,30 +121,19 @@ class Block:
         written += write_fmt(fp, ">i", self.data_present)
 
         if self.data_present:
-
-            offset = fp.tell()
-            written += write_fmt(fp, ">i", 0)
-            written += write_fmt(fp, "<i", 0)
-
-            data_written = write_bytes(fp, self.data)
-            written += data_written
-
-            fp.seek(offset, 0)
-            write_fmt(fp, ">i", data_written + 4)
-            write_fmt(fp, "<i", data_written)
-
-            fp.seek(0, 2)
+            written += write_fmt(fp, ">i", len(self.data) + 4)
+            written += write_fmt(fp, "<i", len(self.data))
+            written += write_bytes(fp, self.data)
 
         written += write_fmt(fp, ">i", len(Block.end_chunk_signature) // 2)
         written += write_bytes(fp, Block.end_chunk_signature)
 
-        fp.seek(block_size_offset)
-        write_fmt(fp, ">i", written)
-
-        fp.seek(0, 2)
-
         return written
 
+    def recompress(self, profile):
+        if self.data_present:
+            self.data = codec.compress(codec.decompress(self.data), profile)
+
     def tobytes(self):
         data = io.BytesIO()
         written = self.write(data)
@@ -119,25 +149,38 @@ class Block:
 
         return 0
 
+def _mark_modified(instance, attribute, value):
+    instance.modified = True
+    return value
+
 @define
 class VectorChunk():
 
-    data: bytes
+    data: bytes = field(on_setattr=_mark_modified)
+    modified: bool = field(default=False, eq=False, repr=False)
 
     @classmethod
     def read(cls, fp):
         return cls(fp.read())
 
+    def is_modified(self):
+        return self.modified
+
+    def byte_size(self):
+        return len(self.data)
+
     def write(self, fp):
         return write_bytes(fp, self.data)
 
 @define
 class BlockData():
 
-    blocks: list
+    blocks: list = field(on_setattr=_mark_modified)
     #block_status: list
     #block_checksums: list
 
+    modified: bool = field(default=False, eq=False, repr=False)
+
     def __len__(self) -> int:
         return self.blocks.__len__()
 
@@ -149,12 +192,15 @@ class BlockData():
 
     def __setitem__(self, key, value) -> None:
         self.blocks.__setitem__(key, value)
+        self.modified = True
 
     def __delitem__(self, key) -> None:
         self.blocks.__delitem__(key)
+        self.modified = True
 
     def remove(self, block):
         self.blocks.remove(block)
+        self.modified = True
         return self
 
     def append(self, block) -> None:
@@ -162,9 +208,11 @@ class BlockData():
 
     def extend(self, layers) -> None:
         self.blocks.extend(layers)
+        self.modified = True
 
     def clear(self) -> None:
         self.blocks.clear()
+        self.modified = True
 
     def index(self, block) -> int:
         return self.blocks.index(block)
@@ -238,6 +286,22 @@ class BlockData():
 
         return BlockData(blocks) #, block_status, block_checksums)
 
+    def is_modified(self):
+        return self.modified or any(block.modified for block in self.blocks)
+
+    def recompress(self, profile):
+        for block in self.blocks:
+            block.recompress(profile)
+
+    def byte_size(self):
+
+        # Blocks, then the status and checksum sections with one int per block
+        size = sum(block.byte_size() for block in self)
+        size += 16 + len(Block.status_chunk_signature) + 4 * len(self)
+        size += 16 + len(Block.checksum_chunk_signature) + 4 * len(self)
+
+        return size
+
     def write(self, fp):
 
         written = 0
@@ -270,6 +334,10 @@ class BlockData():
 
         return written
 
+# Lazily opened chunks share the source file, a seek then read must not interleave
+# with another thread's
+_source_lock = threading.Lock()
+
 class DataChunk:
 
     chunk_signature: str = b'CHNKExta'
@@ -278,9 +346,59 @@ class DataChunk:
     block_data: BlockData
     vector_chunk: VectorChunk
 
-    def __init__(self, external_chunk_id, block_data):
+    # Position of the chunk signature and size of the block payload in the source file
+    offset: int
+    size: int
+
+    def __init__(self, external_chunk_id, block_data, source=None, offset=None, size=None, raw=None):
         self.external_chunk_id = external_chunk_id
-        self.block_data = block_data
+        self._block_data = block_data
+
+        self._source = source
+        self.offset = offset
+        self.size = size
+
+        # Payload as found in the source file, written back as is while the blocks are untouched
+        self._raw = raw
+
+    @property
+    def block_data(self):
+
+        # Lazily opened chunks only parse their blocks when first accessed
+        if self._block_data is None and self._source is not None:
+            with _source_lock:
+
+                # Checked again, another thread may have loaded it meanwhile
+                if self._block_data is None and self._source is not None:
+                    self._source.seek(self.payload_offset)
+                    self._raw = self._source.read(self.size)
+                    self._block_data = BlockData.read(BufferReader(self._raw))
+
+        return self._block_data
+
+    @block_data.setter
+    def block_data(self, new_block_data):
+        self._block_data = new_block_data
+
+        self._source = None
+        self._raw = None
+
+    @property
+    def payload_offset(self):
+        return self.offset + 32 + len(self.external_chunk_id)
+
+    @property
+    def modified(self):
+
+        # New chunks have no source payload to copy from
+        if self._raw is None and self._source is None:
+            return True
+
+        return self._block_data is not None and self._block_data.is_modified()
+
+    @property
+    def is_loaded(self):
+        return self._block_data is not None
 
     @classmethod
     def new_id(cls):
@@ -304,48 +422,62 @@ class DataChunk:
         )
 
     @classmethod
-    def read(cls, fp):
+    def read(cls, fp, lazy=False):
 
+        offset = fp.tell() - 8
         external_chunk_size = read_fmt(">q", fp)
 
         external_chunk_id_length = read_fmt(">q", fp)
-        external_chunk_id = fp.read(external_chunk_id_length)
+        external_chunk_id = bytes(fp.read(external_chunk_id_length))
         #external_chunk_id = read_csp_str(">q", fp)
 
         external_chunk_size_2 = read_fmt(">q", fp)
 
         assert external_chunk_size == external_chunk_size_2 + external_chunk_id_length + 16
 
-        block_raw = io.BytesIO(fp.read(external_chunk_size_2))
+        if lazy:
+            # Only index the chunk, the payload is read back from fp on first access
+            fp.seek(external_chunk_size_2, 1)
+            return cls(external_chunk_id, None, fp, offset, external_chunk_size_2)
+
+        # Blocks keep memoryview slices of the chunk payload, no copy per block
+        raw = fp.read(external_chunk_size_2)
+
+        block_datas = BlockData.read(BufferReader(raw))
 
-        block_datas = BlockData.read(block_raw)
+        return cls(external_chunk_id, block_datas, offset=offset, size=external_chunk_size_2, raw=raw)
 
-        return cls(external_chunk_id, block_datas)
+    def data_size(self):
+
+        if not self.modified:
+            return self.size
+
+        return self.block_data.byte_size()
+
+    def byte_size(self):
+        return 32 + len(self.external_chunk_id) + self.data_size()
 
     def write(self, fp):
 
-        written = write_bytes(fp, DataChunk.chunk_signature)
+        data_size = self.data_size()
 
-        size_offset = fp.tell()
-        written += write_fmt(fp, ">q", 0)
+        written = write_bytes(fp, DataChunk.chunk_signature)
+        written += write_fmt(fp, ">q", data_size + len(self.external_chunk_id) + 16)
 
         #written += write_csp_str(">q", fp, self.external_chunk_id)
         written += write_fmt(fp, ">q", len(self.external_chunk_id))
         written += write_bytes(fp, self.external_chunk_id)
 
-        size2_offset = fp.tell()
-        written += write_fmt(fp, ">q", 0)
-
-        data_written = self.block_data.write(fp)
-        written += data_written
-
-        fp.seek(size_offset)
-        write_fmt(fp, ">q", written - 16)
-
-        fp.seek(size2_offset)
-        write_fmt(fp, ">q", written - (len(self.external_chunk_id) + 32))
+        written += write_fmt(fp, ">q", data_size)
 
-        fp.seek(0, 2)
+        # Untouched chunks are copied from the source instead of being rebuilt
+        if self.modified:
+            written += self.block_data.write(fp)
+        elif self._raw is not None:
+            written += write_bytes(fp, self._raw)
+        else:
+            with _source_lock:
+                written += copy_bytes(self._source, self.payload_offset, self.size, fp)
 
         return written
 
@@ -356,7 +488,7 @@ class DataChunks(dict):
         return cls()
 
     @classmethod
-    def read(cls, fp): # chunkSizes
+    def read(cls, fp, lazy=False): # chunkSizes
 
         chunks = DataChunks()
 
@@ -364,7 +496,7 @@ class DataChunks(dict):
 
             signature = fp.read(8)
             if signature == DataChunk.chunk_signature:
-                chunk = DataChunk.read(fp)
+                chunk = DataChunk.read(fp, lazy)
             elif signature == Database.chunk_signature:
                 fp.seek(-8, 1)
                 break
@@ -373,14 +505,22 @@ class DataChunks(dict):
 
         return chunks
 
-    def write(self, fp):
+    def offsets(self, start):
 
+        # Offsets the chunks will be written at, known before writing anything
         external_id_offsets = []
 
+        for chunk_id in self:
+            external_id_offsets.append((chunk_id, start))
+            start += self[chunk_id].byte_size()
+
+        return external_id_offsets, start
+
+    def write(self, fp):
+
         written = 0
 
         for chunk_id in self:
-            external_id_offsets.append((chunk_id, fp.tell()))
             written += self[chunk_id].write(fp)
 
-        return external_id_offsets, written
\ No newline at end of file
+        return written
@@ -1,9 +1,7 @@
 import sqlite3
-import tempfile
 import importlib
-import os
 
-from collections import namedtuple
+import attr
 
 from clip_tools.utils import read_fmt, write_fmt, write_bytes
 
@@ -16,13 +14,23 @@ class Database:
         if database is None:
             database = self.init_db()
 
-        self.database_file = tempfile.NamedTemporaryFile("wb", delete=False)
+        # The database lives in memory, the chunk is loaded and dumped as is
+        self.db_conn = sqlite3.connect(":memory:")
+        self.db_conn.deserialize(database)
+        self.db_cursor = self.db_conn.cursor()
 
-        self.database_file.write(database)
-        self.database_file.close()
+        # Raw rows grouped by (table, column) then by column value, see prefetch
+        self._prefetched = {}
 
-        self.db_conn = sqlite3.connect(self.database_file.name)
-        self.db_cursor = self.db_conn.cursor()
+        # Row to ClipData object functions, built once per table
+        self._row_mappers = {}
+
+        # Saved objects waiting for flush, by table then PW_ID
+        self._pending = {}
+        self._upsert_queries = {}
+
+        # Next free ids by (table, column), handed out without querying the database
+        self._free_ids = {}
 
         self.init_scheme()
 
@@ -44,10 +52,15 @@ class Database:
             self.param_scheme[row[1]][row[2]] = dict(zip(self.table_scheme["ParamScheme"][3:], row[3:]))
 
     def update_scheme(self, table):
-        self.table_scheme[table] = [
-            x[0].removeprefix('_')
-            for x in self._execute_query(f"SELECT name FROM pragma_table_info('{table}')")
-        ]
+
+        self._row_mappers.pop(table, None)
+
+        columns = [x[0] for x in self._execute_query(f"SELECT name FROM pragma_table_info('{table}')")]
+
+        self.table_scheme[table] = [column.removeprefix('_') for column in columns]
+        self._upsert_queries[table] = (
+            f"INSERT OR REPLACE INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+        )
 
     def init_db(self):
         
@@ -59,31 +72,87 @@ class Database:
 
         return database
 
+    def serialize(self):
+        self.flush()
+        return self.db_conn.serialize()
+
+    def close(self):
+        self.db_cursor.close()
+        self.db_conn.close()
+
     def _execute_query(self, query):
 
         self.db_cursor.execute(query)
         return self.db_cursor.fetchall()
 
-    def get_free_main_id(self, table):
+    def _next_free_id(self, table, column):
 
-        if table not in self.table_scheme:
-            return 1
+        # The max is only queried once, ids are then reserved in memory so objects
+        # waiting for flush don't get the same one
+        if (table, column) not in self._free_ids:
+
+            free_id = None
 
-        return self._execute_query(f"select max(MainId) from {table}")[0][0] + 1
+            if table in self.table_scheme:
+                free_id = self._execute_query(f"select max({column}) from {table}")[0][0]
+
+            self._free_ids[(table, column)] = 1 if free_id is None else free_id + 1
+
+        free_id = self._free_ids[(table, column)]
+        self._free_ids[(table, column)] = free_id + 1
+
+        return free_id
+
+    def get_free_main_id(self, table):
+        return self._next_free_id(table, "MainId")
 
     def get_free_pw_id(self, table):
+        return self._next_free_id(table, "_PW_ID")
 
-        if table not in self.table_scheme:
-            return 1
+    def stage(self, obj, row):
 
-        free_id = self._execute_query(f"select max(_PW_ID) from {table}")[0][0]
+        # Queues the row of a saved object, written on the next flush
+        table = obj.__class__.__name__
 
-        if free_id is None:
-            return 1
-        
-        return free_id + 1
+        if row == obj._saved_row:
+            # Nothing changed since it was loaded or last written, drop any older staged row
+            staged = self._pending.get(table)
+
+            if staged is not None:
+                staged.pop(obj.PW_ID, None)
+
+                if not staged:
+                    del self._pending[table]
+
+            return
+
+        self._pending.setdefault(table, {})[obj.PW_ID] = (obj, row)
+
+    def flush(self):
+
+        # Writes every staged row in a single transaction
+
+        if not self._pending:
+            return
+
+        pending = self._pending
+        self._pending = {}
+
+        self.clear_prefetch()
+
+        with self.db_conn:
+            for table, staged in pending.items():
+                self.db_cursor.executemany(
+                    self._upsert_queries[table],
+                    [row for _, row in staged.values()]
+                )
+
+        for staged in pending.values():
+            for obj, row in staged.values():
+                obj._saved_row = row
 
     def fetch_project_data(self):
+        self.flush()
         return self._row_to_object(self._execute_query(f"Select * from Project")[0], "Project")
 
     def get_table(self, table):
@@ -94,6 +163,8 @@ class Database:
         if table not in self.table_scheme:
             return None # Raise an exception
 
+        self.flush()
+
         return self._map_results(self._execute_query(f"Select * from {table}"), table)
 
     def get_referenced_items(self, table, column, value):
@@ -101,48 +172,56 @@ class Database:
         if table not in self.table_scheme:
             return None # Raise an exception
 
-        return self._map_results(
-            self._execute_query(f"Select * from {table} where {column}=={value}"),
-            table
-        )
+        self.flush()
 
-    def delete_from_db(self, table, value):
-        if table not in self.table_scheme:
-            return None # Raise an exception
+        groups = self._prefetched.get((table, column))
+        if groups is not None:
+            # Mapped on every call, callers each get their own objects to edit
+            return self._map_results(groups.get(value, ()), table)
 
-        return self._execute_query(f"DELETE FROM {table} where MainId = {value}")
+        self.db_cursor.execute(f"Select * from {table} where {column} == ?", (value,))
 
-    def edit_entry(self, table, value_dict):
+        return self._map_results(self.db_cursor.fetchall(), table)
 
-        query = f"""UPDATE {table} SET
-                {", ".join([f"{x[0]} = ?" for x in self._execute_query(f"SELECT name FROM pragma_table_info('{table}')")])}
-                WHERE _PW_ID = ?;
-                """
+    def prefetch(self, tables, column):
 
-        values = list(value_dict.values())
-        values.append(value_dict["PW_ID"])
+        # Reads each table once and groups its rows by column, get_referenced_items
+        # is then answered from memory until the database is written to
 
-        self.db_cursor.execute(query, tuple(values))
-        self.db_conn.commit()
+        self.flush()
 
-    def insert_new_entry(self, table, value_dict):
+        for table in tables:
 
-        query = f"""INSERT INTO {table}
-                ({", ".join([x[0] for x in self._execute_query(f"SELECT name FROM pragma_table_info('{table}')")])})
-                VALUES ({", ".join(["?" for _ in range(len(value_dict))])});
-                """
+            if table not in self.table_scheme or column not in self.table_scheme[table]:
+                continue
 
-        if value_dict["PW_ID"] == -1:
-            value_dict["PW_ID"] = self.get_free_pw_id(table)
+            groups = {}
+            index = self.table_scheme[table].index(column)
 
-        self.db_cursor.execute(query, tuple(value_dict.values()))
-        self.db_conn.commit()
+            # Only the rows are kept, objects are built per get_referenced_items call
+            for row in self._execute_query(f"Select * from {table}"):
+                groups.setdefault(row[index], []).append(row)
+
+            self._prefetched[(table, column)] = groups
+
+    def clear_prefetch(self):
+        self._prefetched.clear()
+
+    def delete_from_db(self, table, value):
+        if table not in self.table_scheme:
+            return None # Raise an exception
+
+        self.flush()
+        self.clear_prefetch()
 
-        return value_dict["PW_ID"]
+        self.db_cursor.execute(f"DELETE FROM {table} where MainId = ?", (value,))
+        return self.db_cursor.fetchall()
 
     def create_table(self, table):
         query = f"CREATE TABLE {table} (_PW_ID INTEGER PRIMARY KEY)"
+        self.flush()
         self.db_cursor.execute(query)
+        self.clear_prefetch()
         self.update_scheme(table)
 
     def alter_table(self, table, new_columns):
@@ -151,33 +230,56 @@ class Database:
                     {"; ".join([f"ALTER TABLE {table} ADD {new_column}" for new_column in new_columns])};
                     COMMIT;"""
 
+        self.flush()
         self.db_cursor.executescript(query)
+        self.clear_prefetch()
         self.update_scheme(table)
 
     def _map_results(self, rows, table):
         mapped_values = {}
 
+        mapper = self._row_mapper(table)
+
         for row in rows:
 
-            mapped_row = self._row_to_object(row, table)
+            mapped_row = mapper(row)
             mapped_values[mapped_row.MainId] = mapped_row
 
         return mapped_values
 
     def _row_to_object(self, row, table):
+        return self._row_mapper(table)(row)
+
+    def _row_mapper(self, table):
+
+        mapper = self._row_mappers.get(table)
+
+        if mapper is not None:
+            return mapper
 
         scheme = self.table_scheme[table]
-        data_type = namedtuple(table, scheme)
 
         _module = importlib.import_module("clip_tools.clip.ClipData")
         _class = getattr(_module, table)
 
-        mapped_row = data_type(*row)._asdict()
+        field_names = [field.alias for field in attr.fields(_class) if field.init]
+
+        # Loaded objects remember their row to know if a save has anything to write
+        if field_names[1:len(scheme) + 1] == scheme:
+            # Columns are in the same order as the class fields, rows can be passed as is
+            def mapper(row):
+                obj = _class(self, *row)
+                obj._saved_row = row
+                return obj
+        else:
+            def mapper(row):
+                obj = _class(self, **dict(zip(scheme, row)))
+                obj._saved_row = row
+                return obj
 
-        mapped_row["db"] = self
-        #del mapped_row["PW_ID"]
+        self._row_mappers[table] = mapper
 
-        return _class(**mapped_row)
+        return mapper
 
     @classmethod
     def new(cls):
@@ -193,7 +295,9 @@ class Database:
 
         return cls(database)
 
-    def write(self, fp, ext_id_offsets):
+    def set_external_chunks(self, ext_id_offsets):
+
+        self.flush()
 
         self._execute_query("DELETE FROM ExternalChunk")
 
@@ -205,23 +309,17 @@ class Database:
 
         self.db_conn.commit()
 
-        fp.write(Database.chunk_signature)
-
-        offset = fp.tell()
-        write_fmt(fp, ">q", 0)
+    def write(self, fp, database=None):
 
-        self.db_cursor.close()
-        self.db_conn.close()
-
-        with open(self.database_file.name, "rb") as db_file:
-            written = write_bytes(fp, db_file.read())
-
-        fp.seek(offset)
-        write_fmt(fp, ">q", written)
+        # The serialized database can be passed when its size was needed beforehand
+        if database is None:
+            database = self.serialize()
 
-        fp.seek(0, 2)
+        written = write_bytes(fp, Database.chunk_signature)
+        written += write_fmt(fp, ">q", len(database))
+        written += write_bytes(fp, database)
 
-        os.unlink(self.database_file.name)
+        return written
 
     def _scheme_to_classes(self):
         # Cursed data class writing
@@ -1,3 +1,5 @@
+from clip_tools.utils import write_bytes
+
 class Footer:
     
     chunk_signature = b'CHNKFoot'
@@ -9,7 +11,12 @@ class Footer:
         footer_data = fp.read(8) # 8 0x00
         #print(footer_data)
 
+    @classmethod
+    def byte_size(cls):
+        return 16
+
     @classmethod
     def write(cls, fp):
-        fp.write(Footer.chunk_signature)
-        fp.write(8*b'\x00')
\ No newline at end of file
+        written = write_bytes(fp, Footer.chunk_signature)
+        written += write_bytes(fp, 8*b'\x00')
+        return written
\ No newline at end of file
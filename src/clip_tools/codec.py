@@ -0,0 +1,37 @@
+import zlib
+
+from clip_tools.constants import CompressionProfile
+
+try:
+    from isal import isal_zlib
+except ImportError:
+    isal_zlib = None
+
+# Blocks are plain zlib streams, isal_zlib produces and reads the same format faster
+backend = isal_zlib if isal_zlib is not None else zlib
+
+# (module, level) per profile, small always uses stdlib zlib for its best ratio
+PROFILE_LEVELS = {
+    CompressionProfile.FAST: (backend, 1),
+    CompressionProfile.BALANCED: (backend, 2 if backend is isal_zlib else 6),
+    CompressionProfile.SMALL: (zlib, 9),
+}
+
+DEFAULT_PROFILE = CompressionProfile.FAST
+
+def compress(data, profile=None):
+    """
+    Compresses a block payload with the level of ``profile``.
+
+    :param profile: a :class:`CompressionProfile` or its name (``"fast"``,
+        ``"balanced"``, ``"small"``), defaults to ``DEFAULT_PROFILE``.
+    """
+    if profile is None:
+        profile = DEFAULT_PROFILE
+
+    module, level = PROFILE_LEVELS[CompressionProfile(profile)]
+
+    return module.compress(data, level)
+
+def decompress(data):
+    return backend.decompress(data)
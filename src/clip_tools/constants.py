@@ -365,3 +365,8 @@ class AntiAliasing(IntEnum):
     WEAK = 1
     MEDIUM = 2
     STRONG = 3
+
+class CompressionProfile(Enum):
+    FAST = "fast"
+    BALANCED = "balanced"
+    SMALL = "small"
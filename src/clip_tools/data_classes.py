@@ -437,6 +437,27 @@ class PixelPackingAttribute():
     @classmethod
     def new(cls, color_mode):
 
+        if color_mode == ColorMode.MONOCHROME:
+            # 1 bit color and alpha, as saved by CSP
+            return cls(
+                bit_order = CanvasChannelOrder.ALPHA | CanvasChannelOrder.BW,
+                alpha_channel_count = 1,
+                buffer_channel_count = 1,
+                total_channel_count = 1,
+                buffer_block_byte_count = (256*256) // 8,
+                buffer_channel_count2 = 1,
+                buffer_bit_depth = 1,
+                alpha_channel_count2 = 1,
+                alpha_bit_depth = 1,
+                buffer_block_area = 256 * 256,
+                block_width = 256,
+                block_height = 256,
+                unk1 = 8,
+                unk2 = 8,
+                monochrome = True,
+                unk3 = 0
+            )
+
         pil_mode = ColorMode.pil_mode(color_mode)
 
         return cls(
@@ -454,10 +475,52 @@ class PixelPackingAttribute():
             block_height = 256,
             unk1 = 8,
             unk2 = 8,
-            monochrome = color_mode == ColorMode.MONOCHROME,
+            monochrome = False,
             unk3 = 0
         )
 
+@define
+class ResizableImageInfo():
+
+    # Placement of the original image of an image layer, only the values known so
+    # far are read. The pivot point of the image is drawn at position on the
+    # canvas, scaled and rotated (degrees) around it. Tiled images repeat over
+    # the canvas, tile_direction 1 horizontally, 2 vertically, 3 both
+
+    tiled: bool
+    tile_direction: int
+
+    width: int
+    height: int
+
+    scale: Position
+    angle: float
+    position: Position
+    pivot: Position
+
+    @classmethod
+    def read(cls, io_stream):
+
+        if not isinstance(io_stream, io.BytesIO):
+            io_stream = io.BytesIO(io_stream)
+
+        io_stream.seek(16) # Section sizes
+
+        tiled = bool(read_fmt(">i", io_stream))
+        tile_direction = read_fmt(">i", io_stream)
+
+        io_stream.seek(8, 1) # Usually 2, 2
+
+        width = read_fmt(">i", io_stream)
+        height = read_fmt(">i", io_stream)
+
+        scale = Position.read(io_stream)
+        angle = read_fmt(">d", io_stream)
+        position = Position.read(io_stream)
+        pivot = Position.read(io_stream)
+
+        return cls(tiled, tile_direction, width, height, scale, angle, position, pivot)
+
 @define
 class OffscreenAttribute():
 
@@ -1,10 +1,13 @@
 import io
-import zlib
-from isal import isal_zlib
+import os
 import concurrent.futures
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
 from PIL import Image, ImageChops
 from clip_tools.utils import read_fmt, read_csp_unicode_str, read_csp_str, read_csp_unicode_le_str, decompositor, channel_to_pil
 from clip_tools.clip.DataChunk import DataChunk, BlockData, Block
+from clip_tools import codec
 from clip_tools.constants import TextAttribute, TextAlign, TextStyle, TextOutline, TextWrapDirection, VectorFlag, VectorPointFlag
 from clip_tools.data_classes import Position, Color, TextRun, TextParam, BBox, ReadingSetting, TextBackground, TextEdge, OffscreenAttribute, PixelPackingAttribute, ColorMode
 from Cryptodome.Hash import MD5
@@ -14,229 +17,527 @@ import logging
 
 logger = logging.getLogger(__name__)
 
-def decode_chunk_to_pil(chunk, offscreen_attribute):
+# Threads used to decompress blocks when workers isn't given, zlib releases the GIL
+DEFAULT_WORKERS = os.cpu_count() or 1
+
+def _decode_block(block, pix_packing):
+
+    # Decompressed blocks hold the alpha plane(s) first then the interleaved color buffer
+    pix_bytes = np.frombuffer(codec.decompress(block.data), dtype=np.uint8)
+
+    block_shape = (pix_packing.block_height, pix_packing.block_width)
+    block_area = pix_packing.block_width * pix_packing.block_height
+
+    # One 2D view per output channel, copying plane by plane is much faster than
+    # assigning strided 3D slices
+    planes = []
+
+    alpha_byte_count = 0
+
+    if pix_packing.alpha_channel_count != 0:
+        alpha_byte_count = block_area // (8 // pix_packing.alpha_bit_depth) * pix_packing.alpha_channel_count
+
+    if pix_packing.buffer_channel_count != 0:
+
+        buffer_block_byte_count = block_area // (8 // (pix_packing.buffer_bit_depth // pix_packing.buffer_channel_count))
+        block_buffer = pix_bytes[alpha_byte_count:alpha_byte_count + buffer_block_byte_count * pix_packing.buffer_channel_count]
+
+        if pix_packing.monochrome:
+            block_buffer = np.unpackbits(block_buffer) * np.uint8(255)
+
+        block_buffer = block_buffer.reshape(*block_shape, -1)
+
+        # BGRX to RGB, gray stays as is
+        planes.extend(block_buffer[:, :, i] for i in reversed(range(min(block_buffer.shape[2], 3))))
+
+    if pix_packing.alpha_channel_count != 0:
+
+        block_alpha = pix_bytes[:alpha_byte_count]
+
+        if pix_packing.monochrome:
+            block_alpha = np.unpackbits(block_alpha) * np.uint8(255)
+
+        block_alpha = block_alpha.reshape(*block_shape, pix_packing.alpha_channel_count)
+
+        planes.extend(block_alpha[:, :, i] for i in range(pix_packing.alpha_channel_count))
+
+    if len(planes) == 0:
+        raise ValueError("No channels to merge in chunk decoding")
+
+    return planes
+
+def _pack_blocks(blocks, pix_packing):
+
+    # Inverse of _decode_block for several blocks, blocks is a sequence of arrays
+    # with the color channels first then the alpha. Edge blocks may be smaller
+    # than a block, the rest is padded with 0. Blocks without alpha channels are
+    # opaque. Gives one row of uncompressed payload per block
+
+    color_count = min(pix_packing.buffer_channel_count, 3)
+    block_count = len(blocks)
+    block_area = pix_packing.block_width * pix_packing.block_height
+    alpha_size = block_area * pix_packing.alpha_channel_count
+
+    # Alpha then BGRX, the padding channel stays at 0. Channel by channel 2D
+    # copies are much faster than reversing the channels in one strided assignment
+    payloads = np.zeros((block_count, alpha_size + block_area * pix_packing.buffer_channel_count), dtype=np.uint8)
+
+    for payload, block in zip(payloads, blocks):
+
+        block_alpha = payload[:alpha_size].reshape(pix_packing.block_height, pix_packing.block_width, -1)
+        block_buffer = payload[alpha_size:].reshape(pix_packing.block_height, pix_packing.block_width, -1)
+
+        rows, columns = block.shape[:2]
+
+        if block.shape[2] == color_count:
+            block_alpha.fill(255)
+        else:
+            for i in range(pix_packing.alpha_channel_count):
+                block_alpha[:rows, :columns, i] = block[:, :, color_count + i]
+
+        for i in range(color_count):
+            block_buffer[:rows, :columns, i] = block[:, :, color_count - 1 - i]
+
+    if pix_packing.monochrome:
+        payloads = np.concatenate((
+            np.packbits(payloads[:, :alpha_size] > 127, axis=1),
+            np.packbits(payloads[:, alpha_size:] > 127, axis=1)
+        ), axis=1)
+
+    return payloads
+
+def _pack_monochrome_blocks(blocks, pix_packing):
+
+    # _pack_blocks for packed bitmaps, blocks are views of at most block_height x
+    # block_width/8 bytes with the color then the alpha, without alpha it is opaque
+
+    plane_size = pix_packing.block_width * pix_packing.block_height // 8
+    block_bytes = pix_packing.block_width // 8
+
+    payloads = np.zeros((len(blocks), 2 * plane_size), dtype=np.uint8)
+
+    for payload, block in zip(payloads, blocks):
+
+        rows, columns = block.shape[:2]
+
+        block_alpha = payload[:plane_size].reshape(pix_packing.block_height, block_bytes)
+        block_buffer = payload[plane_size:].reshape(pix_packing.block_height, block_bytes)
+
+        if block.shape[2] == 1:
+            block_alpha.fill(0xFF)
+        else:
+            block_alpha[:rows, :columns] = block[:, :, 1]
+
+        block_buffer[:rows, :columns] = block[:, :, 0]
+
+    return payloads
+
+def encode_block(block_array, pix_packing, profile=None):
+
+    # block_array is a full block_height x block_width array with the color
+    # channels first then the alpha
+    return codec.compress(_pack_blocks([block_array], pix_packing)[0], profile)
+
+def _place_block(array, block, h, w, pix_packing, left, top, width, height):
+
+    # array covers the bitmap from (left, top), only the part of the block inside
+    # both the array and the bitmap is copied (edge blocks overflow the bitmap)
+
+    block_top = h * pix_packing.block_height
+    block_left = w * pix_packing.block_width
+
+    y0 = max(block_top, top)
+    y1 = min(block_top + pix_packing.block_height, height, top + array.shape[0])
+    x0 = max(block_left, left)
+    x1 = min(block_left + pix_packing.block_width, width, left + array.shape[1])
+
+    if y0 >= y1 or x0 >= x1:
+        return
+
+    region = array[y0 - top:y1 - top, x0 - left:x1 - left]
+
+    for channel, plane in enumerate(_decode_block(block, pix_packing)):
+        region[:, :, channel] = plane[y0 - block_top:y1 - block_top, x0 - block_left:x1 - block_left]
+
+def decode_chunk_to_array(chunk, offscreen_attribute, workers=None, bbox=None):
+
+    # bbox is (left, top, right, bottom) like PIL, only the blocks it overlaps
+    # are decompressed. Outside of the bitmap is left to the default fill
+
+    if workers is None:
+        workers = DEFAULT_WORKERS
 
     pix_packing = offscreen_attribute.packing_attributes
 
-    total_channel_count = pix_packing.buffer_channel_count + pix_packing.alpha_channel_count
+    # Color channels kept from the buffer (BGRX gives RGB) followed by the alpha
+    channel_count = min(pix_packing.buffer_channel_count, 3) + pix_packing.alpha_channel_count
+
+    height = offscreen_attribute.bitmap_height
+    width = offscreen_attribute.bitmap_width
+
+    if bbox is None:
+        bbox = (0, 0, width, height)
+
+    left, top, right, bottom = bbox
 
-    im = Image.new(
-        channel_to_pil(total_channel_count),
-        (offscreen_attribute.bitmap_width, offscreen_attribute.bitmap_height),
-        255*offscreen_attribute.default_fill_color
+    if right <= left or bottom <= top:
+        raise ValueError("Empty bounding box %r" % (bbox,))
+
+    array = np.full(
+        (bottom - top, right - left, channel_count),
+        255*offscreen_attribute.default_fill_color,
+        dtype=np.uint8
     )
 
-    block_area = pix_packing.block_width * pix_packing.block_height
+    # Blocks overlapping the box, clamped to the block grid
+    first_row = max(top // pix_packing.block_height, 0)
+    last_row = min((bottom - 1) // pix_packing.block_height + 1, offscreen_attribute.block_grid_height)
+    first_column = max(left // pix_packing.block_width, 0)
+    last_column = min((right - 1) // pix_packing.block_width + 1, offscreen_attribute.block_grid_width)
 
-    for h in range(offscreen_attribute.block_grid_height):
-        for w in range(offscreen_attribute.block_grid_width):
-            block = chunk.block_data[h * offscreen_attribute.block_grid_width + w]
-            block_res = b''
+    block_data = chunk.block_data
 
-            if block.data_present:
+    present_blocks = [
+        (block_data[h * offscreen_attribute.block_grid_width + w], h, w)
+        for h in range(first_row, last_row)
+        for w in range(first_column, last_column)
+        if block_data[h * offscreen_attribute.block_grid_width + w].data_present
+    ]
 
-                pix_bytes = zlib.decompress(block.data)
+    if workers <= 1 or len(present_blocks) <= 1:
+        for block, h, w in present_blocks:
+            _place_block(array, block, h, w, pix_packing, left, top, width, height)
 
-                final_channels = []
+        return array
 
-                if pix_packing.buffer_channel_count != 0:
+    # Every block lands in its own region of the array, no locking needed
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(_place_block, array, block, h, w, pix_packing, left, top, width, height)
+            for block, h, w in present_blocks
+        ]
 
-                    buffer_block_byte_count = block_area // (8 // (pix_packing.buffer_bit_depth // pix_packing.buffer_channel_count))
+        for future in futures:
+            future.result()
 
-                    if pix_packing.monochrome:
-                        block_buffer = Image.frombuffer(
-                            "1", 
-                            (pix_packing.block_width, pix_packing.block_height),
-                            pix_bytes[
-                                buffer_block_byte_count * pix_packing.alpha_channel_count:
-                                buffer_block_byte_count *(pix_packing.buffer_channel_count + pix_packing.alpha_channel_count)
-                            ]
-                        )
+    return array
 
-                        block_buffer = block_buffer.convert(channel_to_pil(pix_packing.buffer_channel_count))
+def pack_monochrome(array):
 
-                    else:
-                        block_buffer = Image.frombuffer(
-                            channel_to_pil(pix_packing.buffer_channel_count),
-                            (pix_packing.block_width, pix_packing.block_height),
-                            pix_bytes[
-                                buffer_block_byte_count * pix_packing.alpha_channel_count:
-                                buffer_block_byte_count*(pix_packing.buffer_channel_count + pix_packing.alpha_channel_count)
-                            ]
-                        )
+    # HxW or HxWxC array of 0/255 to the packed bitmap used by monochrome layers,
+    # 8 pixels per byte along the rows, most significant bit first
 
-                    buffer_channels = block_buffer.split()
-                    block_buffer = buffer_channels[:3][::-1]
+    array = np.asarray(array)
 
-                    final_channels.extend(block_buffer)
+    if array.ndim == 2:
+        array = array[:, :, np.newaxis]
 
-                if pix_packing.alpha_channel_count != 0:
+    return np.packbits(array > 127, axis=1)
 
-                    alpha_byte_count = block_area // (8 // pix_packing.alpha_bit_depth)
+def unpack_monochrome(packed, width):
+    return np.unpackbits(packed, axis=1, count=width) * np.uint8(255)
 
-                    if pix_packing.monochrome:
-                        block_alpha = Image.frombuffer(
-                            "1", 
-                            (pix_packing.block_width, pix_packing.block_height),
-                            pix_bytes[:alpha_byte_count * pix_packing.alpha_channel_count]
-                        )
+def _place_monochrome_block(packed, block, h, w, pix_packing):
 
-                        block_alpha = block_alpha.convert(channel_to_pil(pix_packing.alpha_channel_count))
-                    else:
+    # The planes of a monochrome block are already packed like the bitmap, block
+    # columns fall on whole bytes
 
-                        block_alpha = Image.frombuffer(
-                            channel_to_pil(pix_packing.alpha_channel_count),
-                            (pix_packing.block_width, pix_packing.block_height),
-                            pix_bytes[:alpha_byte_count * pix_packing.alpha_channel_count]
-                        )
+    plane_size = pix_packing.block_width * pix_packing.block_height // 8
+    block_bytes = pix_packing.block_width // 8
 
-                    final_channels.extend(block_alpha.split())
+    pix_bytes = np.frombuffer(codec.decompress(block.data), dtype=np.uint8)
 
-                if len(final_channels) == 0:
-                    raise ValueError("No channels to merge in chunk decoding")
+    top = h * pix_packing.block_height
+    left = w * block_bytes
 
-                block_res = Image.merge(channel_to_pil(total_channel_count), final_channels)
+    rows = min(pix_packing.block_height, packed.shape[0] - top)
+    columns = min(block_bytes, packed.shape[1] - left)
 
-                im.paste(block_res, (256*w,256*h))
+    if rows <= 0 or columns <= 0:
+        return
 
-    return im
+    block_alpha = pix_bytes[:plane_size].reshape(pix_packing.block_height, block_bytes)
+    block_buffer = pix_bytes[plane_size:2 * plane_size].reshape(pix_packing.block_height, block_bytes)
 
-def encode_pil_to_chunk(pil_im):
+    packed[top:top + rows, left:left + columns, 0] = block_buffer[:rows, :columns]
+    packed[top:top + rows, left:left + columns, 1] = block_alpha[:rows, :columns]
 
-    chunk_data = DataChunk.new()
+def decode_chunk_to_packed(chunk, offscreen_attribute, workers=None):
 
-    width = pil_im.width
-    height = pil_im.height
-    color_mode = ColorMode.from_pil(pil_im.mode)
+    # Monochrome chunk to an H x ceil(W/8) x 2 packed bitmap (color then alpha,
+    # see pack_monochrome) without ever holding a byte per pixel
 
-    offscreen_attribute = OffscreenAttribute.new(width, height, color_mode)
-    packing_attributes = offscreen_attribute.packing_attributes
+    if workers is None:
+        workers = DEFAULT_WORKERS
 
-    for h in range(offscreen_attribute.block_grid_height):
-        for w in range(offscreen_attribute.block_grid_width):
+    pix_packing = offscreen_attribute.packing_attributes
 
-            image_data = io.BytesIO()
+    if not pix_packing.monochrome:
+        raise ValueError("Only monochrome chunks decode to a packed bitmap")
 
-            block_image = pil_im.crop((
-                w * packing_attributes.block_width,
-                h * packing_attributes.block_height,
-                (w+1) * packing_attributes.block_width,
-                (h+1) * packing_attributes.block_height
-            ))
+    width = offscreen_attribute.bitmap_width
 
-            if block_image.getbbox(alpha_only=False) is None and "A" in block_image.getbands():
-                chunk_data.block_data.append(
-                    Block.new(h * offscreen_attribute.block_grid_width + w, None)
-                )
-                continue
-
-            if "A" in block_image.getbands():
-                alpha_channel = block_image.getchannel("A")
-                image_data.write(alpha_channel.tobytes('raw'))
-            else:
-                mock_alpha = Image.new(
-                    "L",
-                    (packing_attributes.block_width, packing_attributes.block_height),
-                    255
-                )
-                image_data.write(mock_alpha.tobytes('raw'))
+    packed = np.full(
+        (offscreen_attribute.bitmap_height, -(-width // 8), 2),
+        0xFF if offscreen_attribute.default_fill_color else 0,
+        dtype=np.uint8
+    )
 
-            color_bands = tuple(band for band in block_image.getbands() if band != 'A')
+    present_blocks = [
+        (block, index // offscreen_attribute.block_grid_width, index % offscreen_attribute.block_grid_width)
+        for index, block in enumerate(chunk.block_data)
+        if block.data_present
+    ]
 
-            color_channels = Image.merge(
-                block_image.mode.rstrip("A"),
-                [block_image.getchannel(band) for band in color_bands][::-1]
-            )
+    if workers <= 1 or len(present_blocks) <= 1:
+        for block, h, w in present_blocks:
+            _place_monochrome_block(packed, block, h, w, pix_packing)
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(_place_monochrome_block, packed, block, h, w, pix_packing)
+                for block, h, w in present_blocks
+            ]
 
-            if color_channels.mode == "RGB":
-                color_channels.putalpha(0) # Padding
+            for future in futures:
+                future.result()
 
-            image_data.write(color_channels.tobytes('raw'))
+    # Bits past the width are 0 like np.packbits leaves them
+    if width % 8:
+        packed[:, -1] &= np.uint8((0xFF << (8 - width % 8)) & 0xFF)
 
-            compressed_blk = zlib.compress(image_data.getbuffer().tobytes(), level=1)
+    return packed
 
-            chunk_data.block_data.append(Block.new(
-                h * offscreen_attribute.block_grid_width + w,
-                compressed_blk
-            ))
+def array_to_pil(array):
+    if array.shape[2] == 1:
+        return Image.fromarray(array[:, :, 0])
 
-            offscreen_attribute.block_sizes[h * offscreen_attribute.block_grid_width + w] = (112 + len(compressed_blk))
+    return Image.fromarray(array)
 
-    return chunk_data, offscreen_attribute
+def pil_to_array(pil_im):
+
+    array = np.asarray(pil_im)
+
+    if array.ndim == 2:
+        return array[:, :, np.newaxis]
+
+    return array
+
+def decode_chunk_to_pil(chunk, offscreen_attribute, workers=None, bbox=None):
+    return array_to_pil(decode_chunk_to_array(chunk, offscreen_attribute, workers, bbox))
+
+def _prepare_array(array, color_mode=None):
 
+    # array is HxW or HxWxC (gray, gray + alpha, RGB, RGBA) of uint8, booleans are
+    # taken as 0/255. color_mode defaults to gray or RGB from the channel count,
+    # monochrome has to be asked for. Gives the HxWxC array (packed for
+    # monochrome) and its new attribute
 
+    array = np.asarray(array)
+
+    if array.ndim == 2:
+        array = array[:, :, np.newaxis]
+
+    if array.dtype == np.bool_:
+        array = array * np.uint8(255)
+
+    if array.ndim != 3 or array.dtype != np.uint8 or array.shape[2] not in (1, 2, 3, 4):
+        raise ValueError("Expected an HxW or HxWxC uint8 array with 1 to 4 channels, got %s %r" % (array.dtype, array.shape))
+
+    height, width, channel_count = array.shape
+
+    color_count = channel_count - (channel_count in (2, 4))
+
+    if color_mode is None:
+        color_mode = ColorMode.RGB if color_count == 3 else ColorMode.GRAYSCALE
+
+    offscreen_attribute = OffscreenAttribute.new(width, height, color_mode)
 
-# Not sure these two are relevant to keep
-def encoder_worker(img_part_tuple):
+    if color_count != min(offscreen_attribute.packing_attributes.buffer_channel_count, 3):
+        raise ValueError("%d color channels given for a %s layer" % (color_count, ColorMode(color_mode).name))
 
-    img_part = img_part_tuple[0]
-    offscreen_attribute = img_part_tuple[1]
-    w = img_part_tuple[2]
-    h = img_part_tuple[3]
+    # Monochrome blocks are built from the packed bitmap, 8 times smaller
+    if offscreen_attribute.packing_attributes.monochrome:
+        return pack_monochrome(array), offscreen_attribute
 
-    packing_attributes = offscreen_attribute.packing_attributes
+    return array, offscreen_attribute
 
-    image_data = io.BytesIO()
+def _prepare_packed(packed, width):
 
-    if img_part.getbbox(alpha_only=False) is None and "A" in img_part.getbands():
-        return Block.new(h * offscreen_attribute.block_grid_width + w, None)
+    # packed is H x ceil(W/8) or H x ceil(W/8) x 2 (color then alpha), see pack_monochrome
 
-    if "A" in img_part.getbands():
-        alpha_channel = img_part.getchannel("A")
-        image_data.write(alpha_channel.tobytes('raw'))
+    packed = np.asarray(packed)
+
+    if packed.ndim == 2:
+        packed = packed[:, :, np.newaxis]
+
+    if packed.ndim != 3 or packed.dtype != np.uint8 or packed.shape[1] != -(-width // 8) or packed.shape[2] not in (1, 2):
+        raise ValueError("Expected an H x %d or H x %d x 2 uint8 packed bitmap, got %s %r" % (-(-width // 8), -(-width // 8), packed.dtype, packed.shape))
+
+    # Bits past the width are cleared so empty blocks are still found
+    if width % 8:
+        mask = np.uint8((0xFF << (8 - width % 8)) & 0xFF)
+
+        if (packed[:, -1] & ~mask).any():
+            packed = packed.copy()
+            packed[:, -1] &= mask
+
+    return packed, OffscreenAttribute.new(width, packed.shape[0], ColorMode.MONOCHROME)
+
+def _encode_blocks(array, indices, offscreen_attribute, profile=None, workers=1):
+
+    # Compressed payload of the blocks at indices, None for the empty ones.
+    # Without alpha channels the image is opaque and no block is empty
+
+    pix_packing = offscreen_attribute.packing_attributes
+    grid_width = offscreen_attribute.block_grid_width
+
+    has_alpha = array.shape[2] != min(pix_packing.buffer_channel_count, 3)
+
+    # Monochrome arrays are packed, 8 pixels per byte along the rows
+    if pix_packing.monochrome:
+        block_width = pix_packing.block_width // 8
+        pack_blocks = _pack_monochrome_blocks
     else:
-        mock_alpha = Image.new(
-            "L",
-            (packing_attributes.block_width, packing_attributes.block_height),
-            255
-        )
-        image_data.write(mock_alpha.tobytes('raw'))
+        block_width = pix_packing.block_width
+        pack_blocks = _pack_blocks
+
+    # Views of the array, cropped at the bitmap edges
+    blocks = [
+        array[
+            (index // grid_width) * pix_packing.block_height:(index // grid_width + 1) * pix_packing.block_height,
+            (index % grid_width) * block_width:(index % grid_width + 1) * block_width
+        ]
+        for index in indices
+    ]
+
+    # Empty blocks decode to the fill color 0, blocks fully at 0 don't need to be
+    # stored. Reducing the views is cheaper than padding the array into a block stack
+    present = [not has_alpha or block.any() for block in blocks]
 
-    color_bands = tuple(band for band in img_part.getbands() if band != 'A')
+    payloads = pack_blocks([block for block, block_present in zip(blocks, present) if block_present], pix_packing)
+
+    if workers <= 1 or len(payloads) <= 1:
+        compressed = [codec.compress(payload, profile) for payload in payloads]
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            compressed = list(executor.map(lambda payload: codec.compress(payload, profile), payloads))
 
-    color_channels = Image.merge(
-        img_part.mode.rstrip("A"),
-        [img_part.getchannel(band) for band in color_bands][::-1]
+    compressed = iter(compressed)
+
+    return [next(compressed) if block_present else None for block_present in present]
+
+def _blocks_to_chunk(compressed, offscreen_attribute):
+
+    chunk_data = DataChunk.new()
+
+    for index, data in enumerate(compressed):
+
+        block = Block.new(index, data)
+
+        chunk_data.block_data.append(block)
+        offscreen_attribute.block_sizes[index] = block.byte_size()
+
+    return chunk_data, offscreen_attribute
+
+def encode_array_to_chunk(array, color_mode=None, profile=None, workers=None):
+
+    # Blocks are compressed on a thread pool, see encode_array_to_chunk_parallels
+    # for processes
+
+    if workers is None:
+        workers = DEFAULT_WORKERS
+
+    array, offscreen_attribute = _prepare_array(array, color_mode)
+
+    block_count = offscreen_attribute.block_grid_width * offscreen_attribute.block_grid_height
+
+    return _blocks_to_chunk(
+        _encode_blocks(array, range(block_count), offscreen_attribute, profile, workers),
+        offscreen_attribute
     )
 
-    if color_channels.mode == "RGB":
-        color_channels.putalpha(0) # Padding
+def encode_packed_to_chunk(packed, width, profile=None, workers=None):
+
+    # Monochrome chunk from a packed bitmap (see pack_monochrome), the pixels are
+    # never unpacked
 
-    image_data.write(color_channels.tobytes('raw'))
+    if workers is None:
+        workers = DEFAULT_WORKERS
 
-    return Block.new(
-        h * offscreen_attribute.block_grid_width + w,
-        zlib.compress(image_data.getbuffer(), level=1)
+    packed, offscreen_attribute = _prepare_packed(packed, width)
+
+    block_count = offscreen_attribute.block_grid_width * offscreen_attribute.block_grid_height
+
+    return _blocks_to_chunk(
+        _encode_blocks(packed, range(block_count), offscreen_attribute, profile, workers),
+        offscreen_attribute
     )
 
-def encode_pil_to_chunk_parallels(pil_im):
+def encode_pil_to_chunk(pil_im, profile=None, workers=None):
+    return encode_array_to_chunk(pil_to_array(pil_im), ColorMode.from_pil(pil_im.mode), profile, workers)
 
-    chunk_data = DataChunk.new()
+# State of the process pool workers, set once per process by _init_shared_encoder
+_shared_encoder = None
 
-    offscreen_attribute = OffscreenAttribute.new(pil_im)
-    packing_attributes = offscreen_attribute.packing_attributes
+def _init_shared_encoder(shm_name, shape, offscreen_attribute, profile):
 
-    img_parts = []
+    global _shared_encoder
 
-    for h in range(offscreen_attribute.block_grid_height):
-        for w in range(offscreen_attribute.block_grid_width):
+    shm = shared_memory.SharedMemory(name=shm_name)
 
-            block_image = pil_im.crop((
-                w * packing_attributes.block_width,
-                h * packing_attributes.block_height,
-                (w+1) * packing_attributes.block_width,
-                (h+1) * packing_attributes.block_height
-            ))
+    _shared_encoder = (shm, np.ndarray(shape, dtype=np.uint8, buffer=shm.buf), offscreen_attribute, profile)
 
-            img_parts.append((block_image, offscreen_attribute, w, h))
+def _encode_shared_blocks(indices):
 
-            #chunk_data.block_data.append(encoder_worker(block_image, offscreen_attribute, w, h))
+    _, array, offscreen_attribute, profile = _shared_encoder
 
-    with concurrent.futures.ProcessPoolExecutor() as executor:
-        for block in executor.map(encoder_worker, img_parts):
-            chunk_data.block_data.append(block)
+    return _encode_blocks(array, indices, offscreen_attribute, profile)
 
-    return chunk_data, offscreen_attribute
+def encode_array_to_chunk_parallels(array, color_mode=None, profile=None, workers=None):
+
+    # Same output as encode_array_to_chunk, blocks are packed and compressed in
+    # worker processes. The pixels go through shared memory once, workers only
+    # receive runs of block indices and send back the compressed payloads
+
+    if workers is None:
+        workers = DEFAULT_WORKERS
+
+    array, offscreen_attribute = _prepare_array(array, color_mode)
+
+    block_count = offscreen_attribute.block_grid_width * offscreen_attribute.block_grid_height
+
+    if workers <= 1 or block_count <= 1:
+        return _blocks_to_chunk(
+            _encode_blocks(array, range(block_count), offscreen_attribute, profile),
+            offscreen_attribute
+        )
+
+    # A few runs per worker keeps them busy when blocks compress unevenly
+    run_length = max(1, -(-block_count // (workers * 4)))
+    runs = [range(start, min(start + run_length, block_count)) for start in range(0, block_count, run_length)]
+
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+
+    try:
+        np.ndarray(array.shape, dtype=np.uint8, buffer=shm.buf)[...] = array
+
+        # Spawned, forking while the caller has threads running can deadlock the workers
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_shared_encoder,
+            initargs=(shm.name, array.shape, offscreen_attribute, profile)
+        ) as executor:
+            compressed = [data for run in executor.map(_encode_shared_blocks, runs) for data in run]
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return _blocks_to_chunk(compressed, offscreen_attribute)
+
+def encode_pil_to_chunk_parallels(pil_im, profile=None, workers=None):
+    return encode_array_to_chunk_parallels(pil_to_array(pil_im), ColorMode.from_pil(pil_im.mode), profile, workers)
 
 
 # Deprecated
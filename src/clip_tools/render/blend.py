@@ -0,0 +1,293 @@
+from clip_tools.constants import BlendMode
+import numpy as np
+
+# Blend modes on premultiplied RGBA tiles (float32 in 0-1, or uint16).
+#
+# Separable and non separable modes follow the W3C compositing formulas: the
+# kernels get the straight backdrop and source colors (..., 3) and give the
+# blended color, then the result is composited with
+#   co = cs * (1 - ab) + cb * (1 - as) + as * ab * B(Cb, Cs)
+#   ao = as + ab - as * ab
+# Clipped layers use the source atop form, which keeps the backdrop alpha:
+#   co = cb * (1 - as) + as * ab * B(Cb, Cs)
+#
+# Kernels may reuse cs for their result, callers pass a temporary
+
+def _darken(cb, cs):
+    return np.minimum(cb, cs, out=cs)
+
+def _multiply(cb, cs):
+    cs *= cb
+    return cs
+
+def _color_burn(cb, cs):
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result = 1 - np.minimum(1, (1 - cb) / cs)
+
+    result[cs <= 0] = 0
+    result[cb >= 1] = 1
+
+    return result
+
+def _linear_burn(cb, cs):
+    cs += cb
+    cs -= 1
+    return np.maximum(cs, 0, out=cs)
+
+def _substract(cb, cs):
+    return np.maximum(cb - cs, 0, out=cs)
+
+def _lighten(cb, cs):
+    return np.maximum(cb, cs, out=cs)
+
+def _screen(cb, cs):
+    return np.subtract(cb + cs, cb * cs, out=cs)
+
+def _color_dodge(cb, cs):
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result = np.minimum(1, cb / (1 - cs))
+
+    result[cs >= 1] = 1
+    result[cb <= 0] = 0
+
+    return result
+
+def _add(cb, cs):
+    cs += cb
+    return np.minimum(cs, 1, out=cs)
+
+def _hard_light(cb, cs):
+
+    # Multiply under half, screen over it
+    doubled = cs * 2
+    screened = doubled - 1
+    screened = cb + screened - cb * screened
+
+    doubled *= cb
+
+    return np.where(cs <= 0.5, doubled, screened)
+
+def _overlay(cb, cs):
+    return _hard_light(cs, cb.copy())
+
+def _soft_light(cb, cs):
+
+    d = np.where(cb <= 0.25, ((16 * cb - 12) * cb + 4) * cb, np.sqrt(cb))
+
+    return np.where(
+        cs <= 0.5,
+        cb - (1 - 2 * cs) * cb * (1 - cb),
+        cb + (2 * cs - 1) * (d - cb)
+    ).astype(np.float32, copy=False)
+
+def _vivid_light(cb, cs):
+
+    # Color burn under half, color dodge over it
+    low = cs <= 0.5
+
+    return np.where(
+        low,
+        _color_burn(cb, np.where(low, cs * 2, 1)),
+        _color_dodge(cb, np.where(low, 0, cs * 2 - 1))
+    ).astype(np.float32, copy=False)
+
+def _linear_light(cb, cs):
+    cs *= 2
+    cs += cb
+    cs -= 1
+    return np.clip(cs, 0, 1, out=cs)
+
+def _pin_light(cb, cs):
+    doubled = cs * 2
+    return np.where(cs <= 0.5, np.minimum(cb, doubled), np.maximum(cb, doubled - 1)).astype(np.float32, copy=False)
+
+def _hard_mix(cb, cs):
+    return (cb + cs >= 1).astype(np.float32)
+
+def _difference(cb, cs):
+    return np.abs(cb - cs, out=cs)
+
+def _exclusion(cb, cs):
+    return np.subtract(cb + cs, 2 * cb * cs, out=cs)
+
+def _divide(cb, cs):
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result = np.minimum(1, cb / cs)
+
+    result[cs <= 0] = 1
+    result[(cs <= 0) & (cb <= 0)] = 0
+
+    return result
+
+# Non separable helpers, on whole colors
+
+def _lum(c):
+    return c[..., 0] * np.float32(0.3) + c[..., 1] * np.float32(0.59) + c[..., 2] * np.float32(0.11)
+
+def _set_lum(c, lum):
+
+    c = c + (lum - _lum(c))[..., np.newaxis]
+
+    # Clip back into gamut keeping the luminosity
+    lum = _lum(c)[..., np.newaxis]
+    low = c.min(axis=-1, keepdims=True)
+    high = c.max(axis=-1, keepdims=True)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        c = np.where(low < 0, lum + (c - lum) * lum / (lum - low), c)
+        c = np.where(high > 1, lum + (c - lum) * (1 - lum) / (high - lum), c)
+
+    return np.clip(c, 0, 1).astype(np.float32, copy=False)
+
+def _sat(c):
+    return c.max(axis=-1) - c.min(axis=-1)
+
+def _set_sat(c, sat):
+
+    low = c.min(axis=-1, keepdims=True)
+    spread = c.max(axis=-1, keepdims=True) - low
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(spread > 0, (c - low) * sat[..., np.newaxis] / spread, 0).astype(np.float32, copy=False)
+
+def _darker_color(cb, cs):
+    return np.where((_lum(cs) < _lum(cb))[..., np.newaxis], cs, cb)
+
+def _lighter_color(cb, cs):
+    return np.where((_lum(cs) > _lum(cb))[..., np.newaxis], cs, cb)
+
+def _hue(cb, cs):
+    return _set_lum(_set_sat(cs, _sat(cb)), _lum(cb))
+
+def _saturation(cb, cs):
+    return _set_lum(_set_sat(cb, _sat(cs)), _lum(cb))
+
+def _color(cb, cs):
+    return _set_lum(cs, _lum(cb))
+
+def _brightness(cb, cs):
+    return _set_lum(cb, _lum(cs))
+
+# BlendMode -> kernel, NORMAL has its own fast path
+BLEND_FUNCTIONS = {
+    BlendMode.NORMAL: None,
+    BlendMode.DARKEN: _darken,
+    BlendMode.MULTIPLY: _multiply,
+    BlendMode.COLOR_BURN: _color_burn,
+    BlendMode.LINEAR_BURN: _linear_burn,
+    BlendMode.SUBSTRACT: _substract,
+    BlendMode.DARKER_COLOR: _darker_color,
+    BlendMode.LIGHTEN: _lighten,
+    BlendMode.SCREEN: _screen,
+    BlendMode.COLOR_DODGE: _color_dodge,
+    BlendMode.GLOW_DODGE: _color_dodge,
+    BlendMode.ADD: _add,
+    BlendMode.ADD_GLOW: _add,
+    BlendMode.LIGHTER_COLOR: _lighter_color,
+    BlendMode.OVERLAY: _overlay,
+    BlendMode.SOFT_LIGHT: _soft_light,
+    BlendMode.HARD_LIGHT: _hard_light,
+    BlendMode.VIVID_LIGHT: _vivid_light,
+    BlendMode.LINEAR_LIGHT: _linear_light,
+    BlendMode.PIN_LIGHT: _pin_light,
+    BlendMode.HARD_MIX: _hard_mix,
+    BlendMode.DIFFERENCE: _difference,
+    BlendMode.EXCLUSION: _exclusion,
+    BlendMode.HUE: _hue,
+    BlendMode.SATURATION: _saturation,
+    BlendMode.COLOR: _color,
+    BlendMode.BRIGHTNESS: _brightness,
+    BlendMode.DIVIDE: _divide,
+}
+
+# The glow modes blend with the premultiplied source color instead of the
+# straight one, transparent parts of the source still lighten the backdrop
+GLOW_MODES = {BlendMode.GLOW_DODGE, BlendMode.ADD_GLOW}
+
+def _unpremultiply(tile):
+
+    alpha = tile[..., 3:]
+
+    return np.divide(tile[..., :3], alpha, out=np.zeros(tile.shape[:-1] + (3,), dtype=np.float32), where=alpha > 0)
+
+def _blend_float(backdrop, source, mode, clip):
+
+    backdrop_alpha = backdrop[..., 3:]
+    source_alpha = source[..., 3:]
+
+    if mode == BlendMode.NORMAL:
+        if clip:
+            backdrop[..., :3] *= 1 - source_alpha
+            backdrop[..., :3] += source[..., :3] * backdrop_alpha
+        else:
+            backdrop *= 1 - source_alpha
+            backdrop += source
+
+        return
+
+    kernel = BLEND_FUNCTIONS[BlendMode(mode)]
+
+    # Only the pixels both layers cover need the kernel
+    overlap = (source_alpha[..., 0] > 0) & (backdrop_alpha[..., 0] > 0)
+
+    if mode in GLOW_MODES:
+        blended = np.zeros(backdrop.shape[:-1] + (3,), dtype=np.float32)
+        blended[overlap] = kernel(_unpremultiply(backdrop[overlap]), source[overlap][:, :3].copy())
+
+        # Glow modes don't fade the backdrop under the source
+        if clip:
+            backdrop[..., :3] = np.where(overlap[..., np.newaxis], blended * backdrop_alpha, backdrop[..., :3])
+        else:
+            color = blended * backdrop_alpha
+            color += source[..., :3] * (1 - backdrop_alpha)
+
+            backdrop[..., :3] = np.where(overlap[..., np.newaxis], color, backdrop[..., :3] + source[..., :3])
+            backdrop_alpha += source_alpha * (1 - backdrop_alpha)
+
+        np.minimum(backdrop, 1, out=backdrop)
+
+        return
+
+    # as * ab * B(Cb, Cs), 0 out of the overlap
+    mixed = np.zeros(backdrop.shape[:-1] + (3,), dtype=np.float32)
+
+    if overlap.any():
+        mixed[overlap] = kernel(_unpremultiply(backdrop[overlap]), _unpremultiply(source[overlap]))
+        mixed *= source_alpha * backdrop_alpha
+
+    if clip:
+        backdrop[..., :3] *= 1 - source_alpha
+        backdrop[..., :3] += mixed
+        return
+
+    color = source[..., :3] * (1 - backdrop_alpha)
+    color += mixed
+
+    backdrop[..., :3] *= 1 - source_alpha
+    backdrop[..., :3] += color
+
+    backdrop_alpha += source_alpha * (1 - backdrop_alpha)
+
+def blend(backdrop, source, mode=BlendMode.NORMAL, clip=False):
+    """
+    Blends ``source`` onto ``backdrop`` in place.
+
+    Both are premultiplied RGBA tiles of the same shape, float32 in 0-1 or
+    uint16. ``mode`` is a :class:`BlendMode` (``BaseLayer.blend_mode``), with
+    ``clip`` the source is clipped to the backdrop alpha. ``source`` may be
+    modified.
+    """
+    if backdrop.dtype == np.uint16:
+        result = backdrop * np.float32(1 / 65535)
+
+        _blend_float(result, source * np.float32(1 / 65535), mode, clip)
+
+        np.rint(np.clip(result, 0, 1) * 65535, out=result)
+        backdrop[...] = result
+
+        return
+
+    _blend_float(backdrop, source, mode, clip)
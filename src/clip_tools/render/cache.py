@@ -0,0 +1,115 @@
+from collections import OrderedDict
+import threading
+import weakref
+
+DEFAULT_CACHE_SIZE = 512 * 1024 * 1024
+
+# Charged to every entry on top of its tile, tiles where nothing is drawn still
+# take room and get evicted
+ENTRY_SIZE = 1024
+
+# Every live cache, edited layers drop their stale tiles from all of them
+_caches = weakref.WeakSet()
+
+def _intersects(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+def _entry_size(tile):
+    return ENTRY_SIZE + (0 if tile is None else tile.nbytes)
+
+def caches_empty():
+    return not any(len(cache) for cache in list(_caches))
+
+def invalidate_caches(folder, bbox=None):
+
+    # Drops the tiles of folder intersecting the canvas bbox from every cache
+    for cache in list(_caches):
+        cache.invalidate(folder, bbox)
+
+class CompositeCache():
+
+    # LRU of folder composites, one entry per folder and tile bbox, bounded by
+    # the size of the tiles plus ENTRY_SIZE per entry. Each project renders with its own cache (see
+    # Project.render), layers invalidate the tiles of their parent folders in
+    # every cache when they are edited (see BaseLayer._invalidate), edits made
+    # directly on the layer data have to be followed by a clear
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+
+        # (id(folder), bbox) -> (weakref to folder, tile), tile is None where
+        # nothing is drawn. Folders aren't kept alive by the cache, entries of
+        # dead ones are never hit again and age out
+        self._entries = OrderedDict()
+
+        # id(folder) -> bboxes cached for it
+        self._folders = {}
+
+        self._lock = threading.Lock()
+
+        _caches.add(self)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, folder, bbox, default=None):
+
+        with self._lock:
+            entry = self._entries.get((id(folder), bbox))
+
+            if entry is None or entry[0]() is not folder:
+                return default
+
+            self._entries.move_to_end((id(folder), bbox))
+
+            return entry[1]
+
+    def put(self, folder, bbox, tile):
+
+        nbytes = _entry_size(tile)
+
+        if nbytes > self.max_bytes:
+            return
+
+        key = (id(folder), bbox)
+
+        with self._lock:
+            self._pop(key)
+
+            self._entries[key] = (weakref.ref(folder), tile)
+            self._folders.setdefault(id(folder), set()).add(bbox)
+            self.nbytes += nbytes
+
+            while self.nbytes > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+
+    def invalidate(self, folder, bbox=None):
+
+        # Drops the tiles of folder intersecting the canvas bbox, all of them when None
+
+        with self._lock:
+            for cached_bbox in list(self._folders.get(id(folder), ())):
+                if bbox is None or _intersects(cached_bbox, bbox):
+                    self._pop((id(folder), cached_bbox))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._folders.clear()
+            self.nbytes = 0
+
+    def _pop(self, key):
+
+        entry = self._entries.pop(key, None)
+
+        if entry is None:
+            return
+
+        bboxes = self._folders[key[0]]
+        bboxes.discard(key[1])
+
+        if not bboxes:
+            del self._folders[key[0]]
+
+        self.nbytes -= _entry_size(entry[1])
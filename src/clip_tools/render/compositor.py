@@ -0,0 +1,470 @@
+from clip_tools.api.Layer import CorrectionLayer, FolderMixin, GradientLayer, ImageLayer, PixelLayer, PaperLayer
+from clip_tools.constants import LayerVisibility
+from clip_tools.data_classes import OffscreenAttribute
+from clip_tools.parsers import DEFAULT_WORKERS, decode_chunk_to_array
+from clip_tools.render.blend import blend
+from clip_tools.render.cache import CompositeCache
+from clip_tools.render.gradient import rasterize_gradient
+from clip_tools.render.image import rasterize_image
+import concurrent.futures
+import io
+import numpy as np
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Same size as the pixel blocks so a tile decodes at most one block per layer
+TILE_SIZE = 256
+
+# Cached tiles may be None
+_MISSING = object()
+
+def _to_premultiplied(array):
+
+    # Decoded HxWxC uint8 (RGBA or LA) to premultiplied float32 RGBA
+
+    tile = np.empty(array.shape[:2] + (4,), dtype=np.float32)
+
+    alpha = array[:, :, -1] * np.float32(1 / 255)
+    tile[:, :, 3] = alpha
+
+    if array.shape[2] == 2:
+        tile[:, :, 0] = array[:, :, 0]
+        tile[:, :, 0] *= np.float32(1 / 255)
+        tile[:, :, 0] *= alpha
+        tile[:, :, 1] = tile[:, :, 0]
+        tile[:, :, 2] = tile[:, :, 0]
+    else:
+        for channel in range(3):
+            tile[:, :, channel] = array[:, :, channel]
+            tile[:, :, channel] *= np.float32(1 / 255)
+            tile[:, :, channel] *= alpha
+
+    return tile
+
+def _to_straight(tile):
+
+    # Premultiplied float32 RGBA to straight alpha RGBA uint8
+
+    alpha = tile[:, :, 3:]
+
+    rgb = np.divide(tile[:, :, :3], alpha, out=np.zeros_like(tile[:, :, :3]), where=alpha > 0)
+
+    array = np.empty(tile.shape, dtype=np.uint8)
+    array[:, :, :3] = np.rint(np.clip(rgb, 0, 1) * 255)
+    array[:, :, 3] = np.rint(np.clip(tile[:, :, 3], 0, 1) * 255)
+
+    return array
+
+class _Bitmap():
+
+    # Chunk of a pixel or mask offscreen and where it sits on the canvas
+
+    def __init__(self, chunk, offscreen_attribute, left, top):
+        self.chunk = chunk
+        self.offscreen_attribute = offscreen_attribute
+        self.left = left
+        self.top = top
+
+    @classmethod
+    def from_offscreen(cls, clip_file, offscreen, left, top):
+
+        chunk = clip_file.data_chunks.get(offscreen.BlockData)
+
+        if chunk is None:
+            return None
+
+        return cls(chunk, OffscreenAttribute.read(io.BytesIO(offscreen.Attribute)), left, top)
+
+    def blocks_present(self, bbox):
+
+        # Whether any block under the canvas bbox holds data
+
+        attribute = self.offscreen_attribute
+        pix_packing = attribute.packing_attributes
+
+        left, top, right, bottom = bbox
+
+        left -= self.left
+        right -= self.left
+        top -= self.top
+        bottom -= self.top
+
+        first_row = max(top // pix_packing.block_height, 0)
+        last_row = min((bottom - 1) // pix_packing.block_height + 1, attribute.block_grid_height)
+        first_column = max(left // pix_packing.block_width, 0)
+        last_column = min((right - 1) // pix_packing.block_width + 1, attribute.block_grid_width)
+
+        block_data = self.chunk.block_data
+
+        return any(
+            block_data[h * attribute.block_grid_width + w].data_present
+            for h in range(first_row, last_row)
+            for w in range(first_column, last_column)
+        )
+
+    def decode(self, bbox):
+
+        left, top, right, bottom = bbox
+
+        return decode_chunk_to_array(
+            self.chunk,
+            self.offscreen_attribute,
+            1,
+            (left - self.left, top - self.top, right - self.left, bottom - self.top)
+        )
+
+class Compositor():
+
+    # Flattens a canvas tile by tile. Layers are composited bottom to top in
+    # premultiplied float32, each tile only decodes the blocks under it and tiles
+    # where no layer has data are skipped. Folder composites are kept in cache
+    # (a new CompositeCache unless one is given) until a layer under them is
+    # edited, unchanged folders aren't composited again on the next render.
+    # Layers without a renderer (text, vectors, 3D...) are drawn from the
+    # offscreen the application rendered them to when the file has it, and
+    # left out with a warning otherwise
+
+    def __init__(self, canvas, tile_size=TILE_SIZE, cache=None):
+        self.canvas = canvas
+        self.clip_file = canvas.clip_file
+        self.tile_size = tile_size
+        self.cache = CompositeCache() if cache is None else cache
+
+        self.width = int(canvas.width)
+        self.height = int(canvas.height)
+
+        # id(layer) -> _Bitmap or None, filled on first use
+        self._bitmaps = {}
+        self._masks = {}
+        self._corrections = {}
+        self._gradient_luts = {}
+        self._images = {}
+
+        # id(layer) of the layers left out, warned once
+        self._skipped = set()
+
+    @property
+    def shape(self):
+        return (-(-self.height // self.tile_size), -(-self.width // self.tile_size))
+
+    def tile_bbox(self, row, col):
+
+        left = col * self.tile_size
+        top = row * self.tile_size
+
+        return (left, top, min(left + self.tile_size, self.width), min(top + self.tile_size, self.height))
+
+    def render(self, workers=None, bbox=None):
+
+        # Straight alpha HxWx4 uint8 RGBA of the canvas, or of bbox
+        # (left, top, right, bottom) of it. The output is partial when layers
+        # can't be rendered, a warning is logged for each of them
+
+        if workers is None:
+            workers = DEFAULT_WORKERS
+
+        if bbox is None:
+            bbox = (0, 0, self.width, self.height)
+
+        left, top, right, bottom = bbox
+
+        if right <= left or bottom <= top:
+            raise ValueError("Empty bounding box %r" % (bbox,))
+
+        # Gradients and corrections edited in place since the last render drop
+        # their stale composites before any is reused
+        for layer in self.canvas.root_folder.descendants():
+            if isinstance(layer, GradientLayer):
+                self._gradient_luts[id(layer)] = layer.gradient_lut()
+            elif isinstance(layer, CorrectionLayer):
+                self._corrections[id(layer)] = layer.compiled_correction()
+
+        array = np.zeros((bottom - top, right - left, 4), dtype=np.uint8)
+
+        rows, cols = self.shape
+
+        tiles = [
+            (row, col)
+            for row in range(max(top // self.tile_size, 0), min((bottom - 1) // self.tile_size + 1, rows))
+            for col in range(max(left // self.tile_size, 0), min((right - 1) // self.tile_size + 1, cols))
+        ]
+
+        def render_into(row, col):
+
+            tile_left, tile_top, tile_right, tile_bottom = self.tile_bbox(row, col)
+
+            tile = self.render_tile(row, col)
+
+            if tile is None:
+                return
+
+            x0, y0 = max(tile_left, left), max(tile_top, top)
+            x1, y1 = min(tile_right, right), min(tile_bottom, bottom)
+
+            array[y0 - top:y1 - top, x0 - left:x1 - left] = _to_straight(
+                tile[y0 - tile_top:y1 - tile_top, x0 - tile_left:x1 - tile_left]
+            )
+
+        if workers <= 1 or len(tiles) <= 1:
+            for row, col in tiles:
+                render_into(row, col)
+
+            return array
+
+        # Tiles write to their own region of the array
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(render_into, row, col) for row, col in tiles]
+
+            for future in futures:
+                future.result()
+
+        return array
+
+    def render_tile(self, row, col):
+
+        # Premultiplied float32 RGBA of one tile, None when nothing is drawn on it
+        return self._folder_tile(self.canvas.root_folder, self.tile_bbox(row, col))
+
+    def _folder_tile(self, folder, bbox):
+
+        tile = self.cache.get(folder, bbox, _MISSING)
+
+        if tile is _MISSING:
+            tile = self._composite_folder(folder, bbox)
+            self.cache.put(folder, bbox, tile)
+
+        # The cached tile is kept as is, callers blend into theirs
+        return None if tile is None else tile.copy()
+
+    def _composite_folder(self, folder, bbox):
+
+        tile = None
+
+        layers = list(folder)
+        index = 0
+
+        while index < len(layers):
+
+            # A layer and the clipping layers above it are composited together
+            base = layers[index]
+            index += 1
+
+            clipped = []
+
+            while index < len(layers) and layers[index].clipping:
+                clipped.append(layers[index])
+                index += 1
+
+            if not base.visible:
+                continue
+
+            if isinstance(base, CorrectionLayer):
+
+                if clipped:
+                    logger.debug("Skipping layers clipped to the correction layer %r", base)
+
+                if tile is not None:
+                    self._correct(tile, base, bbox)
+
+                continue
+
+            source = self._layer_tile(base, bbox)
+
+            if source is None:
+                continue
+
+            for layer in clipped:
+
+                if not layer.visible:
+                    continue
+
+                if isinstance(layer, CorrectionLayer):
+                    self._correct(source, layer, bbox)
+                    continue
+
+                clip_source = self._layer_tile(layer, bbox)
+
+                if clip_source is None:
+                    continue
+
+                self._blend(source, clip_source, layer, clip=True)
+
+            if tile is None:
+                left, top, right, bottom = bbox
+                tile = np.zeros((bottom - top, right - left, 4), dtype=np.float32)
+
+            self._blend(tile, source, base)
+
+        return tile
+
+    def _layer_tile(self, layer, bbox):
+
+        # Premultiplied tile of a layer with its mask applied, not its opacity.
+        # None when the layer draws nothing there
+
+        mask = self._mask_tile(layer, bbox)
+
+        if mask is False:
+            return None
+
+        if isinstance(layer, FolderMixin):
+            tile = self._folder_tile(layer, bbox)
+
+        elif isinstance(layer, PaperLayer):
+            left, top, right, bottom = bbox
+            color = layer.color
+
+            tile = np.empty((bottom - top, right - left, 4), dtype=np.float32)
+            tile[:, :] = (color.r / 255, color.g / 255, color.b / 255, 1)
+
+        elif isinstance(layer, GradientLayer):
+
+            if id(layer) not in self._gradient_luts:
+                self._gradient_luts[id(layer)] = layer.gradient_lut()
+
+            tile = rasterize_gradient(layer.gradient, bbox, 1, layer._gradient_offset(), self._gradient_luts[id(layer)])
+
+        elif isinstance(layer, ImageLayer) and self._image(layer) is not None:
+            image, info = self._image(layer)
+
+            tile = rasterize_image(image, info, bbox, ((layer._data.LayerOffsetX or 0), (layer._data.LayerOffsetY or 0)))
+
+        elif isinstance(layer, PixelLayer) and layer._pixel_buffer is not None:
+            tile = self._buffer_tile(layer, bbox)
+
+        elif self._bitmap(layer) is not None:
+
+            # Pixel layers, and the others from their render offscreen
+            bitmap = self._bitmap(layer)
+
+            if not bitmap.blocks_present(bbox):
+                return None
+
+            tile = _to_premultiplied(bitmap.decode(bbox))
+
+        elif isinstance(layer, PixelLayer):
+            return None
+
+        else:
+            if id(layer) not in self._skipped:
+                self._skipped.add(id(layer))
+                logger.warning("No renderer for %s %r and no render offscreen in the file, the layer is left out", type(layer).__name__, layer.layer_name)
+
+            return None
+
+        if tile is not None and mask is not None:
+            tile *= mask[:, :, np.newaxis]
+
+        return tile
+
+    def _correct(self, backdrop, layer, bbox):
+
+        # Correction layers recolor the backdrop under their mask, the backdrop
+        # alpha is kept
+
+        if id(layer) not in self._corrections:
+            self._corrections[id(layer)] = layer.compiled_correction()
+
+        compiled = self._corrections[id(layer)]
+
+        if compiled is None:
+            return
+
+        mask = self._mask_tile(layer, bbox)
+
+        if mask is False:
+            return
+
+        alpha = backdrop[:, :, 3:]
+
+        source = np.empty_like(backdrop)
+        source[:, :, :3] = compiled(np.divide(backdrop[:, :, :3], alpha, out=np.zeros_like(backdrop[:, :, :3]), where=alpha > 0))
+        source[:, :, 3] = 1 if mask is None else mask
+        source[:, :, :3] *= source[:, :, 3:]
+
+        self._blend(backdrop, source, layer, clip=True)
+
+    def _buffer_tile(self, layer, bbox):
+
+        # Edits in the pixel buffer of the layer aren't in its chunk until saved
+
+        array = layer._pixel_buffer.array
+        origin_left, origin_top = layer._render_origin()
+
+        left, top, right, bottom = bbox
+
+        x0, y0 = max(left - origin_left, 0), max(top - origin_top, 0)
+        x1, y1 = min(right - origin_left, array.shape[1]), min(bottom - origin_top, array.shape[0])
+
+        if x0 >= x1 or y0 >= y1:
+            return None
+
+        region = np.zeros((bottom - top, right - left, array.shape[2]), dtype=np.uint8)
+        region[y0 + origin_top - top:y1 + origin_top - top, x0 + origin_left - left:x1 + origin_left - left] = array[y0:y1, x0:x1]
+
+        return _to_premultiplied(region)
+
+    def _mask_tile(self, layer, bbox):
+
+        # float32 mask of the layer on the tile, None when nothing is masked and
+        # False when everything is
+
+        if layer.mask is None or not layer._data.LayerVisibility & LayerVisibility.MASK_VISIBLE:
+            return None
+
+        if id(layer) not in self._masks:
+            self._masks[id(layer)] = _Bitmap.from_offscreen(
+                self.clip_file,
+                layer.mask.offscreen,
+                (layer._data.LayerOffsetX or 0) + (layer._data.LayerMaskOffsetX or 0),
+                (layer._data.LayerOffsetY or 0) + (layer._data.LayerMaskOffsetY or 0)
+            )
+
+        bitmap = self._masks[id(layer)]
+
+        if bitmap is None:
+            return None
+
+        if not bitmap.blocks_present(bbox):
+            return None if bitmap.offscreen_attribute.default_fill_color else False
+
+        return bitmap.decode(bbox)[:, :, -1] * np.float32(1 / 255)
+
+    def _image(self, layer):
+
+        # (premultiplied original, ResizableImageInfo) of an image layer, None
+        # when the file doesn't have the original
+
+        if id(layer) not in self._images:
+
+            array = layer.to_numpy()
+            info = layer.image_info
+
+            self._images[id(layer)] = None if array is None or info is None else (_to_premultiplied(array), info)
+
+        return self._images[id(layer)]
+
+    def _bitmap(self, layer):
+
+        if id(layer) not in self._bitmaps:
+
+            mipmap = layer._get_render_mipmap()
+
+            self._bitmaps[id(layer)] = None if mipmap is None else _Bitmap.from_offscreen(
+                self.clip_file,
+                layer._get_render_offscreen(mipmap),
+                *layer._render_origin()
+            )
+
+        return self._bitmaps[id(layer)]
+
+    def _blend(self, backdrop, source, layer, clip=False):
+
+        opacity = layer._data.LayerOpacity / 256
+
+        if opacity < 1:
+            source *= np.float32(opacity)
+
+        blend(backdrop, source, layer.blend_mode, clip)
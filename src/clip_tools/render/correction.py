@@ -0,0 +1,330 @@
+from clip_tools.api import Correction
+import numpy as np
+
+# Correction layers compiled to a 256 entry LUT per channel, with a kernel for
+# the ones mixing channels (HSL, threshold, gradient maps and color balance
+# keeping the brightness). Both work on straight RGB float32 in 0-1
+
+# Input value of every LUT entry
+_INPUT = np.linspace(0, 1, 256)
+
+# Rec. 601 luma, what gray conversions use
+_LUMA = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+class CompiledCorrection():
+
+    def __init__(self, lut=None, kernel=None):
+
+        # 256x3 float32, output of every channel for each 8 bit input
+        self.lut = lut
+
+        # Function of a ...x3 array, applied after the LUT
+        self.kernel = kernel
+
+    def __call__(self, rgb):
+
+        if self.lut is not None:
+            rgb = _apply_lut(self.lut, rgb)
+
+        if self.kernel is not None:
+            rgb = self.kernel(rgb)
+
+        return rgb
+
+def _apply_lut(lut, rgb):
+
+    index = np.rint(np.clip(rgb, 0, 1) * 255).astype(np.uint8)
+
+    return lut[index, np.arange(3)]
+
+def _channel_lut(*channels):
+
+    # 256x3 LUT from the outputs of each channel over _INPUT
+    return np.clip(np.stack(channels, axis=-1), 0, 1).astype(np.float32)
+
+def _then(first, second):
+
+    # Output of second applied to the output of first, both over _INPUT
+    return np.interp(first, _INPUT, second)
+
+def _gray(rgb):
+    return rgb @ _LUMA
+
+# Color space helpers, HSL with every component in 0-1
+
+def _rgb_to_hsl(rgb):
+
+    high = rgb.max(axis=-1)
+    low = rgb.min(axis=-1)
+
+    lightness = (high + low) / 2
+    spread = high - low
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        saturation = np.where(spread > 0, spread / (1 - np.abs(2 * lightness - 1)), 0)
+
+        r, g, b = (np.where(spread > 0, (high - rgb[..., channel]) / spread, 0) for channel in range(3))
+
+    hue = np.where(
+        rgb[..., 0] == high,
+        b - g,
+        np.where(rgb[..., 1] == high, 2 + r - b, 4 + g - r)
+    )
+    hue = (hue / 6) % 1
+
+    return hue, np.clip(saturation, 0, 1), lightness
+
+def _hsl_to_rgb(hue, saturation, lightness):
+
+    amount = saturation * np.minimum(lightness, 1 - lightness)
+
+    channels = []
+
+    for n in (0, 8, 4):
+        k = (n + hue * 12) % 12
+        channels.append(lightness - amount * np.clip(np.minimum(k - 3, 9 - k), -1, 1))
+
+    return np.stack(channels, axis=-1).astype(np.float32)
+
+def _towards(value, amount):
+
+    # Moves value towards 0 (amount < 0) or 1 (amount > 0), amount in -1-1
+    if amount < 0:
+        return value * (1 + amount)
+
+    return value + (1 - value) * amount
+
+# Compilers, one per correction type
+
+def _brightness_contrast(correction):
+
+    values = _towards(_INPUT, correction.brightness / 100)
+
+    # Contrast turns around the middle gray, -100 flattens everything to it
+    slant = np.tan((correction.contrast / 100 + 1) * np.pi / 4)
+    values = (values - 0.5) * slant + 0.5
+
+    return CompiledCorrection(_channel_lut(values, values, values))
+
+def _level_values(level):
+
+    width = max(level.input_right - level.input_left, 1)
+    values = np.clip((_INPUT * 255 - level.input_left) / width, 0, 1)
+
+    # The mid point sets the gamma, stored values are truncated
+    middle = np.clip((level.intput_mid + 0.5 - level.input_left) / width, 0.01, 0.99)
+    values = values ** (np.log(0.5) / np.log(middle))
+
+    return (level.output_left + values * (level.output_right - level.output_left)) / 255
+
+def _level(correction):
+
+    master = _level_values(correction.rgb)
+
+    return CompiledCorrection(_channel_lut(*(
+        _then(_level_values(level), master)
+        for level in (correction.red, correction.green, correction.blue)
+    )))
+
+def _curve_values(curve_list):
+
+    # Cubic Hermite spline through the curve points, Catmull-Rom tangents
+
+    points = sorted((point.input_point, point.output_point) for point in curve_list.points)
+
+    if len(points) < 2:
+        return _INPUT.copy()
+
+    xs = np.array([point[0] for point in points], dtype=np.float64) / 255
+    ys = np.array([point[1] for point in points], dtype=np.float64) / 255
+
+    dx = np.maximum(np.diff(xs), 1e-6)
+    secants = np.diff(ys) / dx
+
+    tangents = np.empty_like(ys)
+    tangents[0] = secants[0]
+    tangents[-1] = secants[-1]
+    tangents[1:-1] = (ys[2:] - ys[:-2]) / np.maximum(xs[2:] - xs[:-2], 1e-6)
+
+    x = np.clip(_INPUT, xs[0], xs[-1])
+    k = np.clip(np.searchsorted(xs, x, side="right") - 1, 0, len(dx) - 1)
+
+    t = np.clip((x - xs[k]) / dx[k], 0, 1)
+    t2 = t * t
+    t3 = t2 * t
+
+    return (
+        (2 * t3 - 3 * t2 + 1) * ys[k]
+        + (t3 - 2 * t2 + t) * dx[k] * tangents[k]
+        + (-2 * t3 + 3 * t2) * ys[k + 1]
+        + (t3 - t2) * dx[k] * tangents[k + 1]
+    )
+
+def _tone_curve(correction):
+
+    master = _curve_values(correction.rgb)
+
+    return CompiledCorrection(_channel_lut(*(
+        _then(np.clip(_curve_values(curve), 0, 1), master)
+        for curve in (correction.red, correction.green, correction.blue)
+    )))
+
+def _hsl(correction):
+
+    hue_shift = correction.hue / 360
+    saturation_amount = correction.saturation / 100
+    luminance_amount = correction.luminance / 100
+
+    def kernel(rgb):
+
+        hue, saturation, lightness = _rgb_to_hsl(rgb)
+
+        return _hsl_to_rgb(
+            (hue + hue_shift) % 1,
+            _towards(saturation, saturation_amount),
+            _towards(lightness, luminance_amount)
+        )
+
+    return CompiledCorrection(kernel=kernel)
+
+def _balance_values(shadows, midtones, highlight):
+
+    # Shifts of one channel weighted by how dark or bright the value is
+
+    a, b, scale = 0.25, 0.333, 0.7
+
+    shadow_weight = np.clip((_INPUT - b) / -a + 0.5, 0, 1) * scale
+    midtone_weight = np.clip((_INPUT - b) / a + 0.5, 0, 1) * np.clip((_INPUT + b - 1) / -a + 0.5, 0, 1) * scale
+    highlight_weight = np.clip((_INPUT + b - 1) / a + 0.5, 0, 1) * scale
+
+    return _INPUT + (shadows * shadow_weight + midtones * midtone_weight + highlight * highlight_weight) / 100
+
+def _color_balance(correction):
+
+    # Positive values go towards red, green and blue
+    lut = _channel_lut(*(
+        _balance_values(getattr(correction.shadows, axis), getattr(correction.midtones, axis), getattr(correction.highlight, axis))
+        for axis in ("cyan", "magenta", "yellow")
+    ))
+
+    if not correction.keep_brightness:
+        return CompiledCorrection(lut)
+
+    def kernel(rgb):
+
+        lightness = _rgb_to_hsl(rgb)[2]
+        hue, saturation, _ = _rgb_to_hsl(_apply_lut(lut, rgb))
+
+        return _hsl_to_rgb(hue, saturation, lightness)
+
+    return CompiledCorrection(kernel=kernel)
+
+def _reverse_gradient(correction):
+
+    values = 1 - _INPUT
+
+    return CompiledCorrection(_channel_lut(values, values, values))
+
+def _posterization(correction):
+
+    levels = correction.level
+    values = np.minimum(np.floor(_INPUT * levels), levels - 1) / (levels - 1)
+
+    return CompiledCorrection(_channel_lut(values, values, values))
+
+def _threshold(correction):
+
+    level = correction.level
+
+    def kernel(rgb):
+
+        white = np.rint(_gray(rgb) * 255) >= level
+
+        return np.repeat(white[..., np.newaxis], 3, axis=-1).astype(np.float32)
+
+    return CompiledCorrection(kernel=kernel)
+
+def stop_lut(color_stops, size=256):
+
+    # size x 4 float32 straight RGBA of the color stops, from position 0 to 100.
+    # The mix curve of a stop shapes the transition to the next one. Colors are
+    # mixed premultiplied, a transparent stop doesn't tint its neighbours
+
+    lut = np.zeros((size, 4), dtype=np.float32)
+
+    if not color_stops:
+        return lut
+
+    stops = sorted(color_stops, key=lambda stop: stop.position)
+
+    positions = np.array([stop.position for stop in stops], dtype=np.float64) / 100
+    colors = np.array([(stop.color.r, stop.color.g, stop.color.b, stop.opacity) for stop in stops], dtype=np.float64) / 255
+    colors[:, :3] *= colors[:, 3:]
+
+    x = np.linspace(0, 1, size)
+
+    lut[x <= positions[0]] = colors[0]
+
+    for index in range(len(stops) - 1):
+
+        left, right = positions[index], positions[index + 1]
+
+        inside = (x > left) & (x <= right)
+
+        if right <= left or not inside.any():
+            continue
+
+        t = (x[inside] - left) / (right - left)
+
+        curve = stops[index].curve_points.points
+
+        if len(curve) >= 2:
+            curve = sorted((point.input_point, point.output_point) for point in curve)
+            t = np.interp(t, [point[0] for point in curve], [point[1] for point in curve])
+
+        lut[inside] = colors[index] + (colors[index + 1] - colors[index]) * t[:, np.newaxis]
+
+    lut[x > positions[-1]] = colors[-1]
+
+    alpha = lut[:, 3:]
+    np.divide(lut[:, :3], alpha, out=lut[:, :3], where=alpha > 0)
+
+    return lut
+
+def _gradient_map(correction):
+
+    lut = stop_lut(correction.color_stops)
+
+    def kernel(rgb):
+
+        mapped = lut[np.rint(np.clip(_gray(rgb), 0, 1) * 255).astype(np.uint8)]
+
+        # Stop opacity lets the original color through
+        opacity = mapped[..., 3:]
+
+        return rgb * (1 - opacity) + mapped[..., :3] * opacity
+
+    return CompiledCorrection(kernel=kernel)
+
+_COMPILERS = {
+    Correction.BrightnessContrast: _brightness_contrast,
+    Correction.Level: _level,
+    Correction.ToneCurve: _tone_curve,
+    Correction.HSL: _hsl,
+    Correction.ColorBalance: _color_balance,
+    Correction.ReverseGradient: _reverse_gradient,
+    Correction.Posterization: _posterization,
+    Correction.Threshold: _threshold,
+    Correction.GradientMap: _gradient_map,
+}
+
+def compile_correction(correction):
+
+    # CompiledCorrection of one of the api.Correction classes
+
+    compiler = _COMPILERS.get(type(correction))
+
+    if compiler is None:
+        raise ValueError("Unsupported correction %r" % (correction,))
+
+    return compiler(correction)
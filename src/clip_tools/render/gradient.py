@@ -0,0 +1,91 @@
+from clip_tools.constants import GradientRepeatMode, GradientShape
+from clip_tools.render.correction import stop_lut
+import numpy as np
+
+# Entries of the stop LUT, fine enough for a gradient over a whole page
+LUT_SIZE = 1024
+
+def gradient_parameter(gradient, xs, ys):
+
+    # Position t along the gradient of the canvas points (xs, ys), 0 at the
+    # start and 1 at the end, with the canvas pixels one unit of t spans
+
+    start, end = gradient.start, gradient.end
+
+    dx = end.x - start.x
+    dy = end.y - start.y
+    length = max(np.hypot(dx, dy), 1e-6)
+
+    xs = xs - start.x
+    ys = ys - start.y
+
+    if gradient.shape == GradientShape.LINEAR:
+        return (xs * dx + ys * dy) / (length * length), length
+
+    if gradient.shape == GradientShape.CIRCLE:
+        return np.hypot(xs, ys) / length, length
+
+    # Ellipse, start to end is the first axis, the second one is scaled by the
+    # ratio of the diameters
+    ratio = gradient.ellipse_diameter / gradient.diameter if gradient.diameter else 1
+
+    u = (xs * dx + ys * dy) / length
+    v = (ys * dx - xs * dy) / length
+
+    return np.hypot(u, v / max(ratio, 1e-6)) / length, length * min(ratio, 1)
+
+def rasterize_gradient(gradient, bbox, scale=1, offset=(0, 0), lut=None):
+
+    # Premultiplied float32 RGBA of the gradient over bbox (left, top, right,
+    # bottom) in pixels at scale. offset moves the gradient on the canvas, lut
+    # is stop_lut(gradient.color_stops, LUT_SIZE) when already computed
+
+    left, top, right, bottom = bbox
+
+    if gradient.is_flat:
+        color = gradient.fill_color
+
+        tile = np.empty((bottom - top, right - left, 4), dtype=np.float32)
+        tile[:, :] = (color.r / 255, color.g / 255, color.b / 255, 1)
+
+        return tile
+
+    if lut is None:
+        lut = stop_lut(gradient.color_stops, LUT_SIZE)
+
+    # Canvas position of the pixel centers
+    xs = ((np.arange(left, right, dtype=np.float32) + 0.5) / scale - offset[0])[np.newaxis, :]
+    ys = ((np.arange(top, bottom, dtype=np.float32) + 0.5) / scale - offset[1])[:, np.newaxis]
+
+    t, length = gradient_parameter(gradient, xs, ys)
+
+    repeat_mode = gradient.repeat_mode
+    coverage = None
+
+    if repeat_mode == GradientRepeatMode.REPEAT:
+        t = t % 1
+
+    elif repeat_mode == GradientRepeatMode.MIRROR:
+        t = 1 - np.abs(t % 2 - 1)
+
+    elif repeat_mode == GradientRepeatMode.EMPTY:
+
+        # Nothing is drawn before the start and after the end, over a pixel
+        # wide edge with anti aliasing
+        outside = np.maximum(-t, t - 1) * length * scale
+
+        if gradient.anti_aliasing:
+            coverage = np.clip(0.5 - outside, 0, 1).astype(np.float32)
+        else:
+            coverage = (outside <= 0).astype(np.float32)
+
+    index = np.rint(np.clip(t, 0, 1) * (len(lut) - 1)).astype(np.intp)
+
+    tile = lut[index]
+
+    if coverage is not None:
+        tile[:, :, 3] *= coverage
+
+    tile[:, :, :3] *= tile[:, :, 3:]
+
+    return tile
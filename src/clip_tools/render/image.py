@@ -0,0 +1,72 @@
+import numpy as np
+
+def _sample(image, columns, rows, repeat_x, repeat_y):
+
+    # Pixels of image at the integer columns and rows (broadcast together), 0
+    # out of the image unless it repeats on that axis
+
+    height, width = image.shape[:2]
+
+    if repeat_x:
+        columns = columns % width
+    if repeat_y:
+        rows = rows % height
+
+    inside = (columns >= 0) & (columns < width) & (rows >= 0) & (rows < height)
+
+    pixels = image[np.clip(rows, 0, height - 1), np.clip(columns, 0, width - 1)]
+    pixels *= inside[..., np.newaxis]
+
+    return pixels
+
+def rasterize_image(image, info, bbox, offset=(0, 0)):
+
+    # Premultiplied float32 RGBA of an image layer over the canvas bbox (left,
+    # top, right, bottom). image is the premultiplied original, info its
+    # ResizableImageInfo, offset the layer offset
+
+    left, top, right, bottom = bbox
+
+    repeat_x = info.tiled and bool(info.tile_direction & 1)
+    repeat_y = info.tiled and bool(info.tile_direction & 2)
+
+    # Pixel centers relative to the position of the pivot
+    xs = (np.arange(left, right, dtype=np.float64) + 0.5 - info.position.x - offset[0])[np.newaxis, :]
+    ys = (np.arange(top, bottom, dtype=np.float64) + 0.5 - info.position.y - offset[1])[:, np.newaxis]
+
+    if info.angle == 0 and info.scale.x == 1 and info.scale.y == 1:
+
+        # Only moved, pixels are copied as is
+        columns = np.floor(xs + info.pivot.x).astype(np.intp)
+        rows = np.floor(ys + info.pivot.y).astype(np.intp)
+
+        return _sample(image, columns, rows, repeat_x, repeat_y)
+
+    # Back to image coordinates, then bilinear interpolation between the 4
+    # pixels around each sample
+    angle = np.radians(info.angle)
+    cos, sin = np.cos(angle), np.sin(angle)
+
+    us = (xs * cos + ys * sin) / info.scale.x + info.pivot.x - 0.5
+    vs = (ys * cos - xs * sin) / info.scale.y + info.pivot.y - 0.5
+
+    columns = np.floor(us)
+    rows = np.floor(vs)
+
+    fx = (us - columns).astype(np.float32)[..., np.newaxis]
+    fy = (vs - rows).astype(np.float32)[..., np.newaxis]
+
+    columns = columns.astype(np.intp)
+    rows = rows.astype(np.intp)
+
+    top_row = _sample(image, columns, rows, repeat_x, repeat_y) * (1 - fx)
+    top_row += _sample(image, columns + 1, rows, repeat_x, repeat_y) * fx
+
+    bottom_row = _sample(image, columns, rows + 1, repeat_x, repeat_y) * (1 - fx)
+    bottom_row += _sample(image, columns + 1, rows + 1, repeat_x, repeat_y) * fx
+
+    top_row *= 1 - fy
+    bottom_row *= fy
+    top_row += bottom_row
+
+    return top_row
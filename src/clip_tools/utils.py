@@ -1,4 +1,6 @@
+import io
 import logging
+import os
 import struct
 
 import attrs
@@ -36,17 +38,145 @@ def write_bytes(fp, data):
     """
     Write bytes to the file object and returns bytes written.
 
+    Doesn't rely on ``fp.tell()``, so non-seekable streams (pipes, sockets)
+    can be written to.
+
     :return: written byte size
     """
-    pos = fp.tell()
-    fp.write(data)
-    written = fp.tell() - pos
+    written = fp.write(data)
+    if written is None: # Some file-likes don't report the written size
+        written = len(data)
     if written != len(data):
         raise IOError(
             "Failed to write data: written=%d, expected=%d." % (written, len(data))
         )
     return written
 
+def _fileno(fp):
+    try:
+        return fp.fileno()
+    except (AttributeError, io.UnsupportedOperation, OSError):
+        return None
+
+def file_identity(fp):
+    """
+    ``(st_dev, st_ino)`` of the file behind ``fp``, None for in memory streams.
+    Tells if two file objects point to the same file on disk.
+    """
+    fd = _fileno(fp)
+
+    if fd is None:
+        return None
+
+    stat = os.fstat(fd)
+
+    return (stat.st_dev, stat.st_ino)
+
+def _copy_fd(src_fd, offset, size, dst_fd):
+
+    copied = 0
+
+    for copy in ("copy_file_range", "sendfile"):
+
+        if not hasattr(os, copy):
+            continue
+
+        try:
+            while copied < size:
+
+                if copy == "copy_file_range":
+                    count = os.copy_file_range(src_fd, dst_fd, size - copied, offset + copied)
+                else:
+                    count = os.sendfile(dst_fd, src_fd, offset + copied, size - copied)
+
+                if count == 0:
+                    break
+
+                copied += count
+
+        except OSError:
+            continue # Unsupported for these descriptors, try the next one
+
+        break
+
+    return copied
+
+def copy_bytes(src, offset, size, dst, buffer_size=1024 * 1024):
+    """
+    Copies ``size`` bytes found at ``offset`` in ``src`` to ``dst``.
+
+    When both ends are real files the copy is done by the kernel with
+    ``os.copy_file_range`` or ``os.sendfile``, otherwise it falls back to
+    buffered reads and writes.
+
+    :return: written byte size
+    """
+    copied = 0
+
+    src_fd = _fileno(src)
+    dst_fd = _fileno(dst)
+
+    if src_fd is not None and dst_fd is not None:
+
+        dst.flush()
+        copied = _copy_fd(src_fd, offset, size, dst_fd)
+
+        # The kernel moved the descriptor, resync the python file object
+        if copied and dst.seekable():
+            dst.seek(os.lseek(dst_fd, 0, os.SEEK_CUR))
+
+    if copied < size:
+        src.seek(offset + copied)
+
+        while copied < size:
+            data = src.read(min(buffer_size, size - copied))
+            if len(data) == 0:
+                raise IOError(
+                    "Failed to copy data: copied=%d, expected=%d." % (copied, size)
+                )
+            copied += write_bytes(dst, data)
+
+    return copied
+
+class BufferReader():
+    """
+    Read-only file object over a bytes-like buffer (bytes, mmap, ...).
+
+    Reads return ``memoryview`` slices of the buffer instead of copies.
+    """
+
+    def __init__(self, buffer):
+        self._view = memoryview(buffer)
+        self._pos = 0
+
+    def read(self, size=-1):
+
+        if size is None or size < 0:
+            end = len(self._view)
+        else:
+            end = min(self._pos + size, len(self._view))
+
+        data = self._view[self._pos:end]
+        self._pos = max(end, self._pos)
+
+        return data
+
+    def seek(self, offset, whence=0):
+
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += len(self._view)
+
+        self._pos = max(offset, 0)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def getbuffer(self):
+        return self._view
+
 def read_csp_unicode_str(size_fmt, f):
     str_size = read_fmt(size_fmt, f)
     if str_size is None:
@@ -0,0 +1,27 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src"))
+
+SAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Samples")
+
+@pytest.fixture
+def sample():
+
+    # Path of a file of tests/Samples
+    def path(name):
+        return os.path.join(SAMPLES, name)
+
+    return path
+
+@pytest.fixture
+def sample_copy(tmp_path):
+
+    # Copy of a sample in tmp_path, for the tests writing to it
+    def copy(name):
+        return shutil.copy(os.path.join(SAMPLES, name), tmp_path / name)
+
+    return copy
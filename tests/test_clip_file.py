@@ -0,0 +1,295 @@
+import io
+import tempfile
+
+import numpy as np
+import pytest
+
+from clip_tools.api.Project import Project
+from clip_tools.clip.ClipStudioFile import ClipStudioFile
+from clip_tools.clip.DataChunk import BlockData, DataChunks
+from clip_tools.clip.Footer import Footer
+from clip_tools.utils import read_fmt
+
+def _saved(project):
+    output = io.BytesIO()
+    project.save(output)
+    return output.getvalue()
+
+# Lazy open
+
+def test_lazy_open_loads_no_chunk(sample):
+
+    with open(sample("Illustration-Blendings.clip"), "rb") as f:
+        project = Project.open(f, lazy=True)
+
+        assert project.clip_file.data_chunks
+        assert not any(chunk.is_loaded for chunk in project.clip_file.data_chunks.values())
+
+def test_lazy_save_equals_full_save(sample):
+
+    with open(sample("Illustration-Blendings.clip"), "rb") as f:
+        full = _saved(Project.open(f))
+
+    with open(sample("Illustration-Blendings.clip"), "rb") as f:
+        assert _saved(Project.open(f, lazy=True)) == full
+
+def test_lazy_chunks_load_from_threads(sample):
+
+    # Render threads load the chunks of a lazy project from the one source file
+    path = sample("specials/Illustration-Base-Animated.clip")
+
+    with open(path, "rb") as f:
+        expected = Project.open(f).render(workers=16)
+
+    for _ in range(3):
+        with open(path, "rb") as f:
+            assert np.array_equal(Project.open(f, lazy=True).render(workers=16), expected)
+
+def test_lazy_save_over_source_path(sample_copy):
+
+    path = sample_copy("Illustration-Blendings.clip")
+
+    with open(path, "rb") as f:
+        expected = _saved(Project.open(f))
+
+    with open(path, "rb") as f:
+        project = Project.open(f, lazy=True)
+
+        project.save(path)
+
+        with open(path, "rb") as saved:
+            assert saved.read() == expected
+
+        # The chunks are still read from the replaced file, only the database
+        # differs (SQLite counts its writes)
+        project.save(path)
+
+        with open(path, "rb") as saved:
+            chunks_end = project.clip_file.header.database_offset
+            assert saved.read()[:chunks_end] == expected[:chunks_end]
+
+def test_lazy_write_into_source_raises(sample_copy):
+
+    path = sample_copy("Illustration-Base.clip")
+
+    with open(path, "rb") as f:
+        project = Project.open(f, lazy=True)
+
+        with open(path, "r+b") as output:
+            with pytest.raises(ValueError):
+                project.save(output)
+
+# Memory mapped open
+
+def test_mmap_save_equals_full_save(sample):
+
+    with open(sample("Illustration-Blendings.clip"), "rb") as f:
+        full = _saved(Project.open(f))
+
+    with open(sample("Illustration-Blendings.clip"), "rb") as f:
+        project = Project.open(f, use_mmap=True)
+
+        chunk = next(iter(project.clip_file.data_chunks.values()))
+        assert isinstance(chunk._raw, memoryview)
+
+        assert _saved(project) == full
+
+        project.close()
+
+def test_mmap_save_over_source_path(sample_copy):
+
+    path = sample_copy("Illustration-Blendings.clip")
+
+    with open(path, "rb") as f:
+        expected = _saved(Project.open(f))
+
+    with open(path, "rb") as f:
+        project = Project.open(f, use_mmap=True)
+        project.save(path)
+
+        # The mapping still holds the replaced file
+        assert _saved(project)[:project.clip_file.header.database_offset] == expected[:project.clip_file.header.database_offset]
+
+        project.close()
+
+    with open(path, "rb") as f:
+        assert f.read() == expected
+
+def test_mmap_write_into_source_raises(sample_copy):
+
+    path = sample_copy("Illustration-Base.clip")
+
+    with open(path, "rb") as f:
+        project = Project.open(f, use_mmap=True)
+
+        with open(path, "r+b") as output:
+            with pytest.raises(ValueError):
+                project.save(output)
+
+        project.close()
+
+# Probe
+
+def test_probe_skips_the_chunks(sample, monkeypatch):
+
+    def fail(*args, **kwargs):
+        raise AssertionError("External chunks read by probe")
+
+    monkeypatch.setattr(DataChunks, "read", fail)
+
+    project = Project.probe(sample("Illustration-Vector.clip"))
+
+    assert project.clip_file.database_only
+    assert len(project.clip_file.data_chunks) == 0
+    assert project.preview.size[0] > 0
+    assert len(list(project.canvas.root_folder.descendants())) > 0
+
+    with pytest.raises(ValueError):
+        project.save(io.BytesIO())
+
+def test_missing_vector_chunk_raises_on_full_open(sample):
+
+    with open(sample("Illustration-Vector.clip"), "rb") as f:
+        project = Project.open(f)
+
+    vector_ids = {
+        row.VectorData
+        for row in project.clip_file.sql_database.get_table("VectorObjectList").values()
+    }
+
+    for vector_id in vector_ids:
+        del project.clip_file.data_chunks[vector_id]
+
+    with pytest.raises(KeyError):
+        Project(project.clip_file, project._data)
+
+# Database
+
+def test_database_stays_in_memory(sample, monkeypatch):
+
+    def fail(*args, **kwargs):
+        raise AssertionError("Temporary file created")
+
+    monkeypatch.setattr(tempfile, "NamedTemporaryFile", fail)
+
+    with open(sample("Illustration-Base.clip"), "rb") as f:
+        clip_file = ClipStudioFile.read(f)
+
+        f.seek(clip_file.header.database_offset + 8)
+        database = f.read(read_fmt(">q", f))
+
+    # Loaded and dumped as is
+    assert clip_file.sql_database.db_conn.serialize() == database
+
+# Writing
+
+class _Pipe():
+
+    # Write only stream, like a pipe or a socket
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+def test_write_to_unseekable_stream(sample):
+
+    with open(sample("Illustration-Blendings.clip"), "rb") as f:
+        expected = _saved(Project.open(f))
+
+    pipe = _Pipe()
+
+    with open(sample("Illustration-Blendings.clip"), "rb") as f:
+        Project.open(f).save(pipe)
+
+    assert bytes(pipe.data) == expected
+    assert read_fmt(">q", io.BytesIO(pipe.data[8:16])) == len(pipe.data)
+
+# Raw passthrough
+
+def test_untouched_chunks_are_copied(sample, monkeypatch):
+
+    with open(sample("Illustration-Blendings.clip"), "rb") as f:
+        project = Project.open(f)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("Untouched chunk rebuilt")
+
+    monkeypatch.setattr(BlockData, "write", fail)
+
+    _saved(project)
+
+def _present_block(project):
+
+    for chunk in project.clip_file.data_chunks.values():
+        if isinstance(chunk.block_data, BlockData):
+            for block in chunk.block_data:
+                if block.data_present:
+                    return chunk, block
+
+def test_block_field_edits_are_saved(sample):
+
+    with open(sample("Illustration-Blendings.clip"), "rb") as f:
+        project = Project.open(f)
+
+    chunk, block = _present_block(project)
+    index = chunk.block_data.index(block)
+
+    assert not chunk.modified
+
+    block.data_present = 0
+
+    assert chunk.modified
+
+    saved = Project.open(io.BytesIO(_saved(project)))
+
+    assert not saved.clip_file.data_chunks[chunk.external_chunk_id].block_data[index].data_present
+
+# In place save
+
+def test_save_inplace_patches_the_database(sample_copy):
+
+    path = sample_copy("Illustration-Blendings.clip")
+
+    with open(path, "rb") as f:
+        original = f.read()
+
+    with open(path, "rb") as f:
+        project = Project.open(f)
+
+    layer = next(project.canvas.root_folder.descendants())
+    layer._data.LayerName = "Patched"
+
+    database_offset = project.clip_file.header.database_offset
+
+    project.save_inplace(path)
+
+    with open(path, "rb") as f:
+        patched = f.read()
+
+    # Chunks untouched, file size and footer written after the new database
+    assert patched[24:database_offset] == original[24:database_offset]
+    assert read_fmt(">q", io.BytesIO(patched[8:16])) == len(patched)
+    assert patched[-16:] == Footer.chunk_signature + 8 * b"\x00"
+
+    with open(path, "rb") as f:
+        reopened = Project.open(f)
+
+    assert next(reopened.canvas.root_folder.descendants()).layer_name == "Patched"
+
+def test_save_inplace_refuses_chunk_edits(sample_copy):
+
+    path = sample_copy("Illustration-Blendings.clip")
+
+    with open(path, "rb") as f:
+        project = Project.open(f)
+
+    _, block = _present_block(project)
+    block.data_present = 0
+
+    with pytest.raises(ValueError):
+        project.save_inplace(path)
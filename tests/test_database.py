@@ -0,0 +1,85 @@
+from clip_tools.api.Project import Project
+
+def _open(sample, name="Illustration-Blendings.clip"):
+    with open(sample(name), "rb") as f:
+        return Project.open(f)
+
+# Prefetch
+
+def test_prefetch_answers_like_the_database(sample):
+
+    project = _open(sample)
+    database = project.clip_file.sql_database
+
+    layer_id = next(project.canvas.root_folder.descendants())._data.MainId
+
+    database.prefetch(["Offscreen"], "LayerId")
+    prefetched = database.get_referenced_items("Offscreen", "LayerId", layer_id)
+
+    database.clear_prefetch()
+    queried = database.get_referenced_items("Offscreen", "LayerId", layer_id)
+
+    assert prefetched.keys() == queried.keys()
+    assert all(prefetched[key] == queried[key] for key in queried)
+
+def test_prefetched_rows_are_not_shared(sample):
+
+    project = _open(sample)
+    database = project.clip_file.sql_database
+
+    layer_id = next(project.canvas.root_folder.descendants())._data.MainId
+
+    database.prefetch(["Offscreen"], "LayerId")
+
+    first = database.get_referenced_items("Offscreen", "LayerId", layer_id)
+    second = database.get_referenced_items("Offscreen", "LayerId", layer_id)
+
+    key = next(iter(first))
+    first[key].Attribute = b""
+
+    assert first[key] is not second[key]
+    assert second[key].Attribute != b""
+
+# Row mappers
+
+def test_row_mapper_is_built_once(sample):
+
+    database = _open(sample).clip_file.sql_database
+
+    mapper = database._row_mapper("Layer")
+
+    assert database._row_mapper("Layer") is mapper
+
+    database.update_scheme("Layer")
+
+    assert database._row_mapper("Layer") is not mapper
+
+# Batched saves
+
+def test_saves_wait_for_flush(sample):
+
+    project = _open(sample)
+    database = project.clip_file.sql_database
+
+    layer = next(project.canvas.root_folder.descendants())
+    query = "Select LayerName from Layer where MainId == %d" % layer._data.MainId
+
+    original_name = database._execute_query(query)[0][0]
+
+    layer._data.LayerName = "Batched"
+    layer._data.save()
+
+    assert database._execute_query(query)[0][0] == original_name
+
+    database.flush()
+
+    assert database._execute_query(query)[0][0] == "Batched"
+
+def test_unchanged_saves_are_not_staged(sample):
+
+    project = _open(sample)
+
+    for layer in project.canvas.root_folder.descendants():
+        layer._data.save()
+
+    assert not project.clip_file.sql_database._pending
@@ -0,0 +1,417 @@
+import io
+import zlib
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from clip_tools import codec
+from clip_tools.api.Project import Project
+from clip_tools.api.Layer import PixelLayer
+from clip_tools.api.Tiles import BlockCache
+from clip_tools.constants import CompressionProfile
+from clip_tools.data_classes import ColorMode
+from clip_tools.data_classes import OffscreenAttribute
+from clip_tools.parsers import (
+    array_to_pil, decode_chunk_to_array, encode_array_to_chunk, encode_array_to_chunk_parallels,
+    pack_monochrome, pil_to_array, unpack_monochrome
+)
+
+def _open(sample, name="Illustration-Locks.clip"):
+    with open(sample(name), "rb") as f:
+        return Project.open(f)
+
+def _saved(project, **kwargs):
+    output = io.BytesIO()
+    project.save(output, **kwargs)
+    return output.getvalue()
+
+def _pixel_layers(project):
+    return [layer for layer in project.canvas.root_folder.descendants() if isinstance(layer, PixelLayer)]
+
+def _drawn_layer(project):
+
+    # First pixel layer with something on it
+    for layer in _pixel_layers(project):
+        array = layer.to_numpy()
+
+        if array is not None and array[:, :, -1].any():
+            return layer
+
+def _offscreen(layer):
+
+    offscreen = layer._get_render_offscreen(layer._get_render_mipmap())
+
+    return layer.clip_file.data_chunks[offscreen.BlockData], OffscreenAttribute.read(io.BytesIO(offscreen.Attribute))
+
+# NumPy decoding
+
+def _reference_decode(chunk, offscreen_attribute):
+
+    # Block by block with zlib, alpha plane then BGRX, RGBA only
+    pix_packing = offscreen_attribute.packing_attributes
+    block_height, block_width = pix_packing.block_height, pix_packing.block_width
+
+    array = np.zeros((
+        offscreen_attribute.block_grid_height * block_height,
+        offscreen_attribute.block_grid_width * block_width,
+        4
+    ), dtype=np.uint8)
+
+    for index, block in enumerate(chunk.block_data):
+
+        if not block.data_present:
+            continue
+
+        pix_bytes = np.frombuffer(zlib.decompress(block.data), dtype=np.uint8)
+
+        alpha = pix_bytes[:block_height * block_width].reshape(block_height, block_width)
+        bgrx = pix_bytes[block_height * block_width:block_height * block_width * 5].reshape(block_height, block_width, 4)
+
+        top = index // offscreen_attribute.block_grid_width * block_height
+        left = index % offscreen_attribute.block_grid_width * block_width
+
+        array[top:top + block_height, left:left + block_width, :3] = bgrx[:, :, 2::-1]
+        array[top:top + block_height, left:left + block_width, 3] = alpha
+
+    return array[:offscreen_attribute.bitmap_height, :offscreen_attribute.bitmap_width]
+
+def test_to_numpy_matches_a_block_by_block_decode(sample):
+
+    layer = _drawn_layer(_open(sample))
+    chunk, offscreen_attribute = _offscreen(layer)
+
+    array = layer.to_numpy()
+
+    assert array.shape == (offscreen_attribute.bitmap_height, offscreen_attribute.bitmap_width, 4)
+    assert np.array_equal(array, _reference_decode(chunk, offscreen_attribute))
+    assert np.array_equal(np.asarray(layer.topil()), array)
+
+# Threaded decoding
+
+def test_threaded_decode_equals_serial_decode(sample):
+
+    project = _open(sample)
+
+    for layer in _pixel_layers(project):
+        assert np.array_equal(layer.to_numpy(workers=4), layer.to_numpy(workers=1))
+
+# Compression profiles
+
+@pytest.mark.parametrize("profile", list(CompressionProfile))
+def test_profiles_round_trip(profile):
+
+    data = bytes(range(256)) * 64
+
+    assert codec.decompress(codec.compress(data, profile)) == data
+    assert zlib.decompress(codec.compress(data, profile.value)) == data
+
+def test_profile_leaves_read_chunks_alone(sample):
+
+    expected = _saved(_open(sample))
+
+    project = _open(sample)
+    saved = _saved(project, profile=CompressionProfile.SMALL)
+
+    chunks_end = project.clip_file.header.database_offset
+
+    assert saved[:chunks_end] == expected[:chunks_end]
+
+def test_recompress_keeps_the_pixels(sample):
+
+    project = _open(sample)
+    expected = [layer.to_numpy() for layer in _pixel_layers(project)]
+
+    saved = Project.open(io.BytesIO(_saved(project, profile=CompressionProfile.SMALL, recompress=True, workers=2)))
+
+    assert all(np.array_equal(layer.to_numpy(), array) for layer, array in zip(_pixel_layers(saved), expected))
+
+    chunk, offscreen_attribute = _offscreen(_drawn_layer(saved))
+
+    for block, size in zip(chunk.block_data, offscreen_attribute.block_sizes):
+        assert size == block.byte_size()
+
+        if block.data_present:
+            assert block.data == zlib.compress(zlib.decompress(block.data), 9)
+
+# Region decoding
+
+@pytest.mark.parametrize("bbox", [(0, 0, 256, 256), (300, 517, 901, 1210), (1200, 1800, 1337, 1920)])
+def test_bbox_decode_is_a_crop_of_the_full_decode(sample, bbox):
+
+    layer = _drawn_layer(_open(sample))
+    left, top, right, bottom = bbox
+
+    assert np.array_equal(layer.to_numpy(bbox=bbox), layer.to_numpy()[top:bottom, left:right])
+
+def test_bbox_decode_only_decompresses_overlapped_blocks(sample, monkeypatch):
+
+    layer = _drawn_layer(_open(sample))
+    chunk, offscreen_attribute = _offscreen(layer)
+
+    decompressed = []
+    decompress = codec.decompress
+
+    def counted(data):
+        decompressed.append(data)
+        return decompress(data)
+
+    monkeypatch.setattr(codec, "decompress", counted)
+
+    pix_packing = offscreen_attribute.packing_attributes
+    index = next(index for index, block in enumerate(chunk.block_data) if block.data_present)
+
+    left = index % offscreen_attribute.block_grid_width * pix_packing.block_width
+    top = index // offscreen_attribute.block_grid_width * pix_packing.block_height
+
+    # Within a single block
+    layer.to_numpy(workers=1, bbox=(left + 10, top + 10, left + 20, top + 20))
+
+    assert decompressed == [chunk.block_data[index].data]
+
+# Scaled decoding
+
+def test_scaled_decode_resizes_the_full_decode(sample):
+
+    layer = _drawn_layer(_open(sample))
+    full = array_to_pil(layer.to_numpy())
+
+    for scale in (0.5, 0.3):
+        array = layer.to_numpy(scale=scale)
+        size = (int(full.width * scale), int(full.height * scale))
+
+        assert array.shape[:2] == (size[1], size[0])
+        assert np.array_equal(array, pil_to_array(full.resize(size, Image.Resampling.BOX)))
+
+    assert np.array_equal(layer.to_numpy(scale=0.5, bbox=(10, 20, 110, 220)), layer.to_numpy(scale=0.5)[20:220, 10:110])
+
+def test_scaled_decode_reads_the_stored_level(sample):
+
+    layer = _drawn_layer(_open(sample))
+    scale, offscreen = layer._get_mipmap_levels(layer._get_render_mipmap())[1]
+
+    width, height = layer.topil().size
+
+    # Distinct content on the half size level, only reachable by decoding it
+    level = np.zeros((int(height * scale), int(width * scale), 4), dtype=np.uint8)
+    level[:, :, 0] = np.arange(level.shape[1]) % 256
+    level[:, :, 3] = 255
+
+    chunk, offscreen_attribute = encode_array_to_chunk(level)
+
+    offscreen.Attribute = offscreen_attribute.tobytes()
+    offscreen.BlockData = chunk.external_chunk_id
+    layer.clip_file.data_chunks[chunk.external_chunk_id] = chunk
+
+    assert scale == 0.5
+    assert np.array_equal(layer.to_numpy(scale=scale), level)
+
+def test_scaled_decode_skips_mismatched_levels(sample):
+
+    # The stored quarter level is larger than the layer, the full size is resized instead
+    layer = next(layer for layer in _pixel_layers(_open(sample, "Illustration-copy.clip")) if layer._data.LayerName == "Layer")
+    full = layer.topil()
+
+    assert np.array_equal(layer.to_numpy(scale=0.25), pil_to_array(full.resize((full.width // 4, full.height // 4), Image.Resampling.BOX)))
+
+# Tiles
+
+def test_tiles_are_crops_of_the_full_decode(sample):
+
+    layer = _drawn_layer(_open(sample))
+    full = layer.to_numpy()
+
+    tiles = layer.tiles(BlockCache())
+    rows, cols = tiles.shape
+
+    assert len(list(tiles)) == rows * cols
+
+    for row in range(rows):
+        for col in range(cols):
+            left, top, right, bottom = tiles.bbox(row, col)
+            assert np.array_equal(tiles[row, col], full[top:bottom, left:right])
+
+    assert np.array_equal(tiles[-1, -1], full[top:bottom, left:right])
+
+    with pytest.raises(IndexError):
+        tiles[rows, 0]
+
+def test_tiles_are_cached_until_the_block_changes(sample):
+
+    layer = _drawn_layer(_open(sample))
+    chunk, _ = _offscreen(layer)
+
+    cache = BlockCache()
+    tiles = layer.tiles(cache)
+
+    index = next(index for index, block in enumerate(chunk.block_data) if block.data_present)
+    key = divmod(index, tiles.shape[1])
+
+    tile = tiles[key]
+
+    assert tiles[key] is tile
+    assert not tile.flags.writeable
+
+    # Same bytes, new payload object
+    chunk.block_data[index].data = bytes(chunk.block_data[index].data)
+
+    assert tiles[key] is not tile
+    assert np.array_equal(tiles[key], tile)
+
+def test_tile_cache_is_bounded(sample):
+
+    layer = _drawn_layer(_open(sample))
+    cache = BlockCache()
+    tiles = layer.tiles(cache)
+
+    tile_size = tiles.tile_width * tiles.tile_height * tiles.channel_count
+    cache.max_bytes = 2 * tile_size
+
+    list(tiles)
+
+    assert 0 < cache.nbytes <= 2 * tile_size
+
+# Pixel buffers
+
+def test_flush_only_reencodes_dirty_blocks(sample):
+
+    project = _open(sample)
+    layer = _drawn_layer(project)
+    chunk, _ = _offscreen(layer)
+
+    blocks = list(chunk.block_data)
+
+    buffer = layer.pixels()
+    buffer[10:20, 300:310] = (255, 0, 0, 255)
+
+    assert buffer.dirty_blocks == {(0, 1)}
+
+    buffer.flush()
+
+    # Row 0, column 1
+    dirty = 1
+
+    assert chunk.block_data[dirty] is not blocks[dirty]
+    assert all(chunk.block_data[index] is block for index, block in enumerate(blocks) if index != dirty)
+    assert not buffer.dirty_blocks
+
+    _, saved_attribute = _offscreen(layer)
+    assert saved_attribute.block_sizes[dirty] == chunk.block_data[dirty].byte_size()
+
+    expected = buffer.array.copy()
+    saved = Project.open(io.BytesIO(_saved(project)))
+
+    assert np.array_equal(_drawn_layer(saved).to_numpy(), expected)
+
+def test_cleared_blocks_are_stored_empty(sample):
+
+    layer = _drawn_layer(_open(sample))
+    chunk, _ = _offscreen(layer)
+
+    index = next(index for index, block in enumerate(chunk.block_data) if block.data_present)
+    tiles = layer.tiles(BlockCache())
+    left, top, right, bottom = tiles.bbox(*divmod(index, tiles.shape[1]))
+
+    buffer = layer.pixels()
+    buffer[top:bottom, left:right] = 0
+    buffer.flush()
+
+    assert not chunk.block_data[index].data_present
+    assert not layer.to_numpy(bbox=(left, top, right, bottom)).any()
+
+# NumPy encoding
+
+def test_from_numpy_round_trips_the_samples(sample):
+
+    project = _open(sample)
+
+    for layer in _pixel_layers(project):
+
+        array = layer.to_numpy()
+        chunk, _ = _offscreen(layer)
+
+        encoded = PixelLayer.from_numpy(project.clip_file, array)
+        encoded_chunk, _ = _offscreen(encoded)
+
+        assert np.array_equal(encoded.to_numpy(), array)
+
+        # Same block layout as the files written by Clip Studio
+        for block, encoded_block in zip(chunk.block_data, encoded_chunk.block_data):
+            if block.data_present and encoded_block.data_present:
+                assert zlib.decompress(encoded_block.data) == zlib.decompress(block.data)
+
+@pytest.mark.parametrize("channel_count", [1, 2, 3, 4])
+def test_encode_array_round_trips(channel_count):
+
+    array = np.random.default_rng(0).integers(0, 256, (300, 517, channel_count), dtype=np.uint8)
+
+    decoded = decode_chunk_to_array(*encode_array_to_chunk(array))
+
+    assert np.array_equal(decoded[:, :, :channel_count], array)
+
+    # Opaque without an alpha channel
+    if channel_count in (1, 3):
+        assert (decoded[:, :, -1] == 255).all()
+
+# Parallel encoding
+
+def _chunk_bytes(chunk, offscreen_attribute):
+    return [block.data for block in chunk.block_data], offscreen_attribute.tobytes()
+
+def _payloads(chunk, offscreen_attribute):
+    return [zlib.decompress(block.data) if block.data_present else None for block in chunk.block_data]
+
+def test_parallel_encoders_equal_the_serial_one(sample):
+
+    arrays = [
+        _drawn_layer(_open(sample)).to_numpy(),
+        np.random.default_rng(0).integers(0, 256, (600, 700, 2), dtype=np.uint8)
+    ]
+
+    for array in arrays:
+
+        # Stdlib zlib output is deterministic, isal may pick other matches from one call to the next
+        expected = _chunk_bytes(*encode_array_to_chunk(array, profile=CompressionProfile.SMALL, workers=1))
+
+        assert _chunk_bytes(*encode_array_to_chunk(array, profile=CompressionProfile.SMALL, workers=4)) == expected
+        assert _chunk_bytes(*encode_array_to_chunk_parallels(array, profile=CompressionProfile.SMALL, workers=2)) == expected
+
+        expected = _payloads(*encode_array_to_chunk(array, workers=1))
+
+        assert _payloads(*encode_array_to_chunk(array, workers=4)) == expected
+        assert _payloads(*encode_array_to_chunk_parallels(array, workers=2)) == expected
+
+# Monochrome
+
+def test_pack_monochrome_round_trips():
+
+    array = np.random.default_rng(0).integers(0, 2, (70, 1337, 2), dtype=np.uint8) * np.uint8(255)
+    packed = pack_monochrome(array)
+
+    assert packed.shape == (70, 168, 2)
+    assert np.array_equal(unpack_monochrome(packed, 1337), array)
+
+def test_to_packed_matches_to_numpy(sample):
+
+    project = _open(sample, "Illustration-Base-Monochrome.clip")
+    layer = _drawn_layer(project)
+
+    array = layer.to_numpy()
+    packed = layer.to_packed(workers=2)
+
+    assert packed.nbytes * 8 // 2 < array.nbytes
+    assert np.array_equal(unpack_monochrome(packed, array.shape[1]), array)
+
+    with pytest.raises(ValueError):
+        _drawn_layer(_open(sample)).to_packed()
+
+def test_monochrome_layers_round_trip(sample):
+
+    project = _open(sample, "Illustration-Base-Monochrome.clip")
+    layer = _drawn_layer(project)
+
+    array = layer.to_numpy()
+    packed = layer.to_packed()
+
+    assert np.array_equal(PixelLayer.from_packed(project.clip_file, packed, array.shape[1]).to_packed(), packed)
+    assert np.array_equal(PixelLayer.from_numpy(project.clip_file, array, color_mode=ColorMode.MONOCHROME).to_numpy(), array)
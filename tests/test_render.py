@@ -0,0 +1,489 @@
+import logging
+
+from attrs import evolve
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from clip_tools.api import Correction
+from clip_tools.api.Layer import CorrectionLayer, GradientLayer
+from clip_tools.api.Project import Project
+from clip_tools.constants import BlendMode
+from clip_tools.data_classes import Color
+from clip_tools.render.blend import blend
+from clip_tools.render.cache import ENTRY_SIZE, CompositeCache
+from clip_tools.render.compositor import Compositor
+from clip_tools.render.correction import compile_correction
+
+def _open(sample, name="Illustration-Locks.clip"):
+    with open(sample(name), "rb") as f:
+        return Project.open(f)
+
+def _preview_difference(project, array):
+
+    # Mean difference with the preview stored by Clip Studio, over white like it
+    image = Image.new("RGBA", (array.shape[1], array.shape[0]), (255, 255, 255, 255))
+    image.alpha_composite(Image.fromarray(array))
+
+    preview = project.preview
+    image = image.convert("RGB").resize(preview.size, Image.Resampling.BOX)
+
+    return np.abs(np.asarray(image, dtype=np.int16) - np.asarray(preview.convert("RGB"), dtype=np.int16)).mean()
+
+# Compositor
+
+@pytest.mark.parametrize("name", ["Illustration-Locks.clip", "Illustration-Mask.clip", "Illustration-Referece.clip", "random.clip"])
+def test_render_matches_the_preview(sample, name):
+
+    project = _open(sample, name)
+    array = project.render()
+
+    assert array.shape == (int(project.canvas.height), int(project.canvas.width), 4)
+    assert array[:, :, 3].any()
+    assert _preview_difference(project, array) < 1
+
+def test_bbox_render_is_a_crop_of_the_full_render(sample):
+
+    full = _open(sample).render(workers=1)
+
+    for bbox in [(0, 0, 256, 256), (100, 333, 1000, 1500), (1200, 1800, 1337, 1920)]:
+        left, top, right, bottom = bbox
+        assert np.array_equal(_open(sample).render(workers=4, bbox=bbox), full[top:bottom, left:right])
+
+    with pytest.raises(ValueError):
+        _open(sample).render(bbox=(10, 10, 10, 20))
+
+def test_render_reuses_the_project_cache(sample, monkeypatch):
+
+    project = _open(sample)
+    expected = project.render()
+
+    assert len(project.composite_cache)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("Folder composited again")
+
+    monkeypatch.setattr(Compositor, "_composite_folder", fail)
+
+    assert np.array_equal(project.render(), expected)
+
+def test_layers_without_renderer_are_warned_about(sample, caplog):
+
+    project = _open(sample, "Illustration-Text.clip")
+
+    with caplog.at_level(logging.WARNING, logger="clip_tools.render.compositor"):
+        project.render()
+
+    assert any("TextLayer" in record.getMessage() for record in caplog.records)
+
+# Blend modes, scalar W3C compositing formulas on straight colors
+
+def _hard_light(cb, cs):
+    return cb * 2 * cs if cs <= 0.5 else cb + (2 * cs - 1) - cb * (2 * cs - 1)
+
+def _color_burn(cb, cs):
+    if cb == 1:
+        return 1
+    if cs == 0:
+        return 0
+    return 1 - min(1, (1 - cb) / cs)
+
+def _color_dodge(cb, cs):
+    if cb == 0:
+        return 0
+    if cs == 1:
+        return 1
+    return min(1, cb / (1 - cs))
+
+def _soft_light(cb, cs):
+    if cs <= 0.5:
+        return cb - (1 - 2 * cs) * cb * (1 - cb)
+    d = ((16 * cb - 12) * cb + 4) * cb if cb <= 0.25 else cb ** 0.5
+    return cb + (2 * cs - 1) * (d - cb)
+
+def _divide(cb, cs):
+    if cs == 0:
+        return 0 if cb == 0 else 1
+    return min(1, cb / cs)
+
+SEPARABLE = {
+    BlendMode.DARKEN: min,
+    BlendMode.MULTIPLY: lambda cb, cs: cb * cs,
+    BlendMode.COLOR_BURN: _color_burn,
+    BlendMode.LINEAR_BURN: lambda cb, cs: max(cb + cs - 1, 0),
+    BlendMode.SUBSTRACT: lambda cb, cs: max(cb - cs, 0),
+    BlendMode.LIGHTEN: max,
+    BlendMode.SCREEN: lambda cb, cs: cb + cs - cb * cs,
+    BlendMode.COLOR_DODGE: _color_dodge,
+    BlendMode.ADD: lambda cb, cs: min(cb + cs, 1),
+    BlendMode.OVERLAY: lambda cb, cs: _hard_light(cs, cb),
+    BlendMode.SOFT_LIGHT: _soft_light,
+    BlendMode.HARD_LIGHT: _hard_light,
+    BlendMode.VIVID_LIGHT: lambda cb, cs: _color_burn(cb, 2 * cs) if cs <= 0.5 else _color_dodge(cb, 2 * cs - 1),
+    BlendMode.LINEAR_LIGHT: lambda cb, cs: min(max(cb + 2 * cs - 1, 0), 1),
+    BlendMode.PIN_LIGHT: lambda cb, cs: min(cb, 2 * cs) if cs <= 0.5 else max(cb, 2 * cs - 1),
+    BlendMode.HARD_MIX: lambda cb, cs: 1 if cb + cs >= 1 else 0,
+    BlendMode.DIFFERENCE: lambda cb, cs: abs(cb - cs),
+    BlendMode.EXCLUSION: lambda cb, cs: cb + cs - 2 * cb * cs,
+    BlendMode.DIVIDE: _divide,
+}
+
+def _lum(c):
+    return 0.3 * c[0] + 0.59 * c[1] + 0.11 * c[2]
+
+def _clip_color(c):
+
+    lum = _lum(c)
+    low, high = min(c), max(c)
+
+    if low < 0:
+        c = [lum + (x - lum) * lum / (lum - low) for x in c]
+    if high > 1:
+        c = [lum + (x - lum) * (1 - lum) / (high - lum) for x in c]
+
+    return c
+
+def _set_lum(c, lum):
+    shift = lum - _lum(c)
+    return _clip_color([x + shift for x in c])
+
+def _sat(c):
+    return max(c) - min(c)
+
+def _set_sat(c, sat):
+
+    order = sorted(range(3), key=lambda i: c[i])
+    low, mid, high = order
+    result = [0.0] * 3
+
+    if c[high] > c[low]:
+        result[mid] = (c[mid] - c[low]) * sat / (c[high] - c[low])
+        result[high] = sat
+
+    return result
+
+NON_SEPARABLE = {
+    BlendMode.DARKER_COLOR: lambda cb, cs: cs if _lum(cs) < _lum(cb) else cb,
+    BlendMode.LIGHTER_COLOR: lambda cb, cs: cs if _lum(cs) > _lum(cb) else cb,
+    BlendMode.HUE: lambda cb, cs: _set_lum(_set_sat(cs, _sat(cb)), _lum(cb)),
+    BlendMode.SATURATION: lambda cb, cs: _set_lum(_set_sat(cb, _sat(cs)), _lum(cb)),
+    BlendMode.COLOR: lambda cb, cs: _set_lum(cs, _lum(cb)),
+    BlendMode.BRIGHTNESS: lambda cb, cs: _set_lum(cb, _lum(cs)),
+}
+
+def _reference_blend(backdrop, source, mode, clip):
+
+    # Straight RGBA pixels, premultiplied result
+    cb, ab = list(backdrop[:3]), backdrop[3]
+    cs, as_ = list(source[:3]), source[3]
+
+    if mode == BlendMode.NORMAL:
+        mixed = cs
+    elif mode in NON_SEPARABLE:
+        mixed = NON_SEPARABLE[mode](cb, cs)
+    else:
+        mixed = [SEPARABLE[mode](b, s) for b, s in zip(cb, cs)]
+
+    if clip:
+        color = [b * ab * (1 - as_) + as_ * ab * m for b, m in zip(cb, mixed)]
+        return color + [ab]
+
+    color = [s * as_ * (1 - ab) + b * ab * (1 - as_) + as_ * ab * m for b, s, m in zip(cb, cs, mixed)]
+
+    return color + [as_ + ab - as_ * ab]
+
+def _pixels(seed):
+
+    # Straight float32 RGBA, with fully transparent and opaque pixels
+    pixels = np.random.default_rng(seed).random((1, 400, 4), dtype=np.float32)
+    pixels[0, :50, 3] = 0
+    pixels[0, 50:150, 3] = 1
+
+    return pixels
+
+def _premultiplied(pixels):
+    return np.concatenate((pixels[..., :3] * pixels[..., 3:], pixels[..., 3:]), axis=-1)
+
+@pytest.mark.parametrize("clip", [False, True])
+@pytest.mark.parametrize("mode", [BlendMode.NORMAL, *SEPARABLE, *NON_SEPARABLE])
+def test_blend_modes_follow_the_formulas(mode, clip):
+
+    backdrop = _pixels(0)
+    source = _pixels(1)[:, ::-1].copy()
+
+    expected = np.array([
+        _reference_blend(b.astype(np.float64), s.astype(np.float64), mode, clip)
+        for b, s in zip(backdrop[0], source[0])
+    ])
+
+    result = _premultiplied(backdrop)
+    blend(result, _premultiplied(source), mode, clip)
+
+    assert np.allclose(result[0], expected, atol=1e-4)
+
+    # uint16 tiles go through the same kernels
+    result = np.rint(_premultiplied(backdrop) * 65535).astype(np.uint16)
+    blend(result, np.rint(_premultiplied(source) * 65535).astype(np.uint16), mode, clip)
+
+    assert np.allclose(result[0] / 65535, expected, atol=1e-3)
+
+@pytest.mark.parametrize("mode, glow_mode", [(BlendMode.COLOR_DODGE, BlendMode.GLOW_DODGE), (BlendMode.ADD, BlendMode.ADD_GLOW)])
+def test_glow_modes_equal_their_base_mode_when_opaque(mode, glow_mode):
+
+    backdrop = _pixels(0)
+    source = _pixels(1)
+    source[..., 3] = 1
+
+    expected = _premultiplied(backdrop)
+    blend(expected, _premultiplied(source), mode)
+
+    result = _premultiplied(backdrop)
+    blend(result, _premultiplied(source), glow_mode)
+
+    assert np.allclose(result, expected, atol=1e-6)
+
+# Composite cache
+
+def _hide(name):
+    def edit(root):
+        root.find(name).visible = False
+    return edit
+
+def _set_opacity(root):
+    root.find("Lock alpha with color bg Copy").opacity = 30
+
+def _set_blend_mode(root):
+    root.find("Lock full Copy").blend_mode = BlendMode.DIFFERENCE
+
+def _move_to_root(root):
+    root.find("Lock alpha with color bg Copy").move_to_group(root)
+
+def _delete(root):
+    root.find("Lock alpha with color bg Copy").delete_layer()
+
+def _paint(root):
+    root.find("Lock alpha with color bg Copy").pixels()[300:400, 300:400] = (255, 0, 0, 255)
+
+@pytest.mark.parametrize("edit", [_hide("Lock alpha with color bg Copy"), _set_opacity, _set_blend_mode, _move_to_root, _delete, _paint])
+def test_edits_invalidate_the_cache(sample, edit):
+
+    project = _open(sample)
+    before = project.render()
+
+    edit(project.canvas.root_folder)
+
+    after = project.render()
+
+    assert not np.array_equal(after, before)
+    assert np.array_equal(after, project.render(cache=CompositeCache()))
+
+def test_pixel_edits_only_invalidate_their_tiles(sample):
+
+    project = _open(sample)
+    project.render()
+
+    entries = len(project.composite_cache)
+
+    _paint(project.canvas.root_folder)
+
+    # The root and the folder of the layer lose the tile under the edit
+    assert len(project.composite_cache) == entries - 2
+
+def test_gradient_edits_invalidate_the_cache(sample):
+
+    project = _open(sample, "Illustration-Gradient.clip")
+    root = project.canvas.root_folder
+
+    # Flat fills cover the whole canvas
+    root.find("Fill 1 Copy").visible = False
+    root.find("Fill Layer Copy").visible = False
+
+    layer = root.find("Premier plan au transparent")
+
+    # A column of tiles through the whole gradient, the full canvas is slow to rasterize
+    bbox = (512, 0, 768, int(project.canvas.height))
+    before = project.render(bbox=bbox)
+
+    gradient = layer.gradient
+    layer.gradient = evolve(gradient, color_stops=[evolve(gradient.color_stops[0], color=Color(255, 0, 0)), *gradient.color_stops[1:]])
+
+    edited = project.render(bbox=bbox)
+
+    assert not np.array_equal(edited, before)
+    assert np.array_equal(edited, project.render(bbox=bbox, cache=CompositeCache()))
+
+    # In place, found on the next render
+    layer.gradient.color_stops[0].color = Color(0, 0, 255)
+
+    edited_in_place = project.render(bbox=bbox)
+
+    assert not np.array_equal(edited_in_place, edited)
+    assert np.array_equal(edited_in_place, project.render(bbox=bbox, cache=CompositeCache()))
+
+def test_cache_is_bounded(sample):
+
+    tile_bytes = 256 * 256 * 4 * 4 + ENTRY_SIZE
+    cache = CompositeCache(max_bytes=3 * tile_bytes)
+
+    project = _open(sample)
+
+    assert np.array_equal(project.render(cache=cache), project.render(cache=CompositeCache()))
+    # Tiles where nothing is drawn only cost ENTRY_SIZE
+    assert len(cache)
+    assert cache.nbytes <= 3 * tile_bytes
+
+def test_close_drops_the_project_tiles(sample):
+
+    cache = CompositeCache()
+
+    closed = _open(sample)
+    closed.render(cache=cache)
+
+    entries = len(cache)
+
+    kept = _open(sample)
+    kept.render(cache=cache)
+
+    closed.close()
+
+    assert len(cache) == entries
+    assert not len(closed.composite_cache)
+
+# Corrections
+
+def _colors():
+
+    # Every 8 bit gray and random colors, straight RGB in 0-1
+    gray = np.repeat(np.linspace(0, 1, 256, dtype=np.float32)[:, np.newaxis], 3, axis=1)
+    random = np.rint(np.random.default_rng(0).random((1000, 3)) * 255).astype(np.float32) / 255
+
+    return np.concatenate((gray, random))
+
+@pytest.mark.parametrize("correction", [
+    Correction.BrightnessContrast(),
+    Correction.Level(),
+    Correction.ToneCurve(),
+    Correction.HSL(),
+    Correction.ColorBalance(),
+])
+def test_default_corrections_change_nothing(correction):
+
+    colors = _colors()
+
+    assert np.allclose(compile_correction(correction)(colors), colors, atol=1e-5)
+
+def test_sample_corrections_follow_their_settings(sample):
+
+    root = _open(sample, "Illustration-Corrections.clip").canvas.root_folder
+    colors = _colors()
+
+    # find matches on a part of the name, "Threshold 1" would give "Threshold 170"
+    def corrected(name):
+        return next(layer for layer in root.descendants() if layer.layer_name == name).compiled_correction()(colors)
+
+    gray = np.rint((colors @ np.array([0.299, 0.587, 0.114], dtype=np.float32)) * 255)
+
+    assert np.allclose(corrected("Reverse Gradient 1 Copy"), 1 - colors, atol=1e-6)
+
+    # Levels 18-231 in, 38-195 out on every channel
+    levels = corrected("Level Correction 1 Default")[:256, 0] * 255
+
+    assert np.allclose(levels[:19], 38, atol=1e-3)
+    assert np.allclose(levels[231:], 195, atol=1e-3)
+    assert (np.diff(levels) >= 0).all()
+
+    # Curves go through their points
+    curve = corrected("Tone Curve 128Bottom Copy")[:256, 0] * 255
+
+    assert np.allclose(curve[[0, 128, 255]], [0, 0, 255], atol=1e-3)
+    assert set(np.unique(corrected("Posterization LVL2 Min"))) <= {0, 1}
+    assert len(np.unique(corrected("Posterization LVL15"))) == 15
+
+    assert np.array_equal(corrected("Threshold 1")[:, 0], (gray >= 1).astype(np.float32))
+    assert np.array_equal(corrected("Threshold 255")[:, 0], (gray >= 255).astype(np.float32))
+
+    # Black to white map of the luma
+    assert np.allclose(corrected("Default Gradient map Black/White"), (gray / 255)[:, np.newaxis], atol=2 / 255)
+
+def test_corrections_are_applied_when_rendering(sample):
+
+    project = _open(sample)
+    before = project.render()
+
+    project.canvas.root_folder.append(CorrectionLayer.new(project.clip_file, Correction.ReverseGradient(), "Invert"))
+
+    after = project.render()
+
+    assert np.array_equal(after[:, :, 3], before[:, :, 3])
+
+    opaque = before[:, :, 3] == 255
+
+    assert opaque.any()
+    assert np.array_equal(after[opaque, :3], 255 - before[opaque, :3])
+
+# Gradients
+
+def _gradient_layer(sample, name):
+    root = _open(sample, "Illustration-Gradient.clip").canvas.root_folder
+    return next(layer for layer in root.descendants() if layer.layer_name == name)
+
+def _gradient_t(gradient, xs, ys):
+
+    # Linear gradient parameter of canvas points, in float64
+    dx, dy = gradient.end.x - gradient.start.x, gradient.end.y - gradient.start.y
+    return ((xs - gradient.start.x) * dx + (ys - gradient.start.y) * dy) / (dx * dx + dy * dy)
+
+def test_linear_gradient_follows_its_line(sample):
+
+    # Black to white from start to end
+    layer = _gradient_layer(sample, "BW Top/Down Gradient Copy")
+    array = layer.to_numpy()
+
+    ys, xs = np.mgrid[0:array.shape[0], 0:array.shape[1]] + 0.5
+    expected = np.clip(_gradient_t(layer.gradient, xs, ys), 0, 1) * 255
+
+    assert (array[:, :, 3] == 255).all()
+    assert np.abs(array[:, :, :3] - expected[:, :, np.newaxis]).max() <= 1
+
+def test_repeating_gradient_wraps(sample):
+
+    # Opaque black to transparent white, over and over
+    layer = _gradient_layer(sample, "Repeating Gradient Copy")
+    array = layer.to_numpy()
+
+    ys, xs = np.mgrid[0:array.shape[0], 0:array.shape[1]] + 0.5
+    t = _gradient_t(layer.gradient, xs, ys) % 1
+
+    # Away from the seams, where float rounding picks either end
+    inside = (t > 1e-3) & (t < 1 - 1e-3)
+
+    assert np.abs(array[:, :, 3][inside] - (1 - t[inside]) * 255).max() <= 1
+
+def test_gradient_regions_are_crops(sample):
+
+    for name in ["Circle Gradient Copy", "Ellipse Gradient Copy", "No Draw Gradient Opacity 50 Copy"]:
+
+        layer = _gradient_layer(sample, name)
+        full = layer.to_numpy()
+
+        assert np.array_equal(layer.to_numpy(bbox=(100, 333, 700, 1500)), full[333:1500, 100:700])
+
+        half = layer.to_numpy(scale=0.5)
+        resized = np.asarray(Image.fromarray(full).resize((half.shape[1], half.shape[0]), Image.Resampling.BOX))
+
+        assert half.shape == (full.shape[0] // 2, full.shape[1] // 2, 4)
+        assert np.abs(half[:, :, 3].astype(np.int16) - resized[:, :, 3]).mean() < 1
+
+def test_gradient_layers_are_rendered(sample):
+
+    project = _open(sample, "Illustration-Gradient.clip")
+    layer = next(layer for layer in project.canvas.root_folder.descendants() if layer.layer_name == "BW Top/Down Gradient Copy")
+
+    for other in project.canvas.root_folder.descendants():
+        if isinstance(other, GradientLayer) and other is not layer:
+            other.visible = False
+
+    bbox = (512, 0, 768, int(project.canvas.height))
+
+    assert np.array_equal(project.render(bbox=bbox), layer.to_numpy(bbox=bbox))